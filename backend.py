@@ -0,0 +1,104 @@
+import numpy as np
+
+# Labels2ROIs runs the same array code on NumPy (host) or CuPy (device). A backend
+# wraps the handful of operations that differ between the two modules: moving
+# arrays, scatter min/max and the final transfer back to the host.
+
+_cupy = False  # Not checked yet
+
+
+def get_cupy():
+    """Return the cupy module if a CUDA device is usable, otherwise None.
+
+    CuPy is imported on the first call, so runs that never use the GPU do not pay
+    for importing it.
+    """
+    global _cupy
+    if _cupy is False:
+        try:
+            import cupy as cp
+            _cupy = cp if cp.cuda.runtime.getDeviceCount() > 0 else None
+        except Exception:
+            _cupy = None
+    return _cupy
+
+
+class NumpyBackend:
+    """Host backend; also the fallback whenever no CUDA device is usable."""
+
+    name = 'numpy'
+
+    def __init__(self):
+        self.xp = np
+
+    def asarray(self, array):
+        return np.asarray(array)
+
+    def to_host(self, *arrays):
+        """Return the arrays as NumPy arrays (a tuple when given several)."""
+        arrays = tuple(np.asarray(array) for array in arrays)
+        return arrays if len(arrays) > 1 else arrays[0]
+
+    def scatter_min(self, target, index, values):
+        np.minimum.at(target, index, values)
+
+    def scatter_max(self, target, index, values):
+        np.maximum.at(target, index, values)
+
+    def blend(self, first, alpha, second, beta):
+        """Per-pixel first * alpha + second * beta as uint8, rounded like cv2.addWeighted."""
+        import cv2
+        return cv2.addWeighted(np.asarray(first), alpha, np.asarray(second), beta, 0)
+
+
+class CupyBackend(NumpyBackend):
+    """Device backend: arrays stay on the GPU until to_host is called."""
+
+    name = 'cupy'
+
+    def __init__(self, cp):
+        self.xp = cp
+
+    def asarray(self, array):
+        return self.xp.asarray(array)
+
+    def to_host(self, *arrays):
+        """Copy the arrays to the host, packing same-dtype arrays into one transfer."""
+        cp = self.xp
+        if len(arrays) == 1:
+            return cp.asnumpy(arrays[0])
+
+        results = [None] * len(arrays)
+        by_dtype = {}
+        for i, array in enumerate(arrays):
+            by_dtype.setdefault(array.dtype, []).append(i)
+        for indices in by_dtype.values():
+            packed = cp.asnumpy(cp.concatenate([arrays[i].ravel() for i in indices]))
+            offset = 0
+            for i in indices:
+                size = arrays[i].size
+                results[i] = packed[offset:offset + size].reshape(arrays[i].shape)
+                offset += size
+        return tuple(results)
+
+    def scatter_min(self, target, index, values):
+        import cupyx
+        cupyx.scatter_min(target, index, values)
+
+    def scatter_max(self, target, index, values):
+        import cupyx
+        cupyx.scatter_max(target, index, values)
+
+    def blend(self, first, alpha, second, beta):
+        cp = self.xp
+        blended = cp.asarray(first, dtype=cp.float32) * alpha + cp.asarray(second, dtype=cp.float32) * beta
+        return cp.clip(cp.rint(blended), 0, 255).astype(cp.uint8)
+
+
+NUMPY_BACKEND = NumpyBackend()
+
+
+def get_backend(use_gpu=True):
+    """Return the CuPy backend when use_gpu is set and a device is usable, otherwise the NumPy backend."""
+    cp = get_cupy() if use_gpu else None
+    return CupyBackend(cp) if cp is not None else NUMPY_BACKEND
@@ -0,0 +1,319 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+import pipeline
+
+# Headless, CPU-only benchmarks of the Labels2ROIs, summary and segmentation stages.
+# Originals are the TIFFs in ExampleDataset; label images are generated with a fixed
+# layout, so the same command gives comparable numbers on every commit:
+#
+#   python benchmark.py --output before.json
+#   (change something)
+#   python benchmark.py --compare before.json
+
+BENCHMARKS = ('excel', 'overlays', 'summary', 'segmentation')
+DEFAULT_LABELS = (10, 1000, 10000, 50000)
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ExampleDataset')
+
+
+def synthetic_labels(shape, n_labels):
+    """Label image of the given shape with n_labels disc-shaped cells on a regular grid.
+
+    The layout depends only on shape and n_labels, so runs are reproducible.
+    """
+    height, width = shape
+    grid = int(np.ceil(np.sqrt(n_labels)))
+    cell_h, cell_w = height / grid, width / grid
+    radius = 0.4 * min(cell_h, cell_w)
+
+    rows = np.arange(height)
+    cols = np.arange(width)
+    cell_y = np.minimum((rows / cell_h).astype(np.int64), grid - 1)
+    cell_x = np.minimum((cols / cell_w).astype(np.int64), grid - 1)
+    dy = rows - (cell_y + 0.5) * cell_h
+    dx = cols - (cell_x + 0.5) * cell_w
+
+    inside = dy[:, None] ** 2 + dx[None, :] ** 2 < radius ** 2
+    labels = cell_y[:, None] * grid + cell_x[None, :] + 1
+    labels[~inside | (labels > n_labels)] = 0
+    return labels.astype(np.uint16 if n_labels < 2**16 else np.uint32)
+
+
+class MockModel:
+    """Stands in for a Cellpose model: eval returns synthetic labels without running a network."""
+
+    def __init__(self, n_labels=1000):
+        self.n_labels = n_labels
+        self._masks = {}
+
+    def _labels(self, image):
+        shape = image.shape[:2]
+        if shape not in self._masks:
+            self._masks[shape] = synthetic_labels(shape, self.n_labels)
+        return self._masks[shape]
+
+    def eval(self, x, **kwargs):
+        if isinstance(x, list):
+            masks = [self._labels(image) for image in x]
+            return masks, [[np.zeros(1)] for _ in x], [None] * len(x), [kwargs.get('diameter')] * len(x)
+        return self._labels(x), [np.zeros(1)], None, kwargs.get('diameter')
+
+
+def install_cellpose_stand_in():
+    """Make `from cellpose import io, transforms` work when Cellpose (or torch) is not installed.
+
+    The segmentation benchmark times the pipeline around the model (reading,
+    smoothing, batching, saving) with a MockModel, so it only needs the few
+    cellpose.io and cellpose.transforms calls segment.py makes. Returns
+    'cellpose' when the real package is used and 'stand-in' otherwise; the two
+    do not give comparable timings.
+    """
+    try:
+        importlib.import_module('cellpose.io')
+        importlib.import_module('cellpose.transforms')
+        return 'cellpose'
+    except ImportError:
+        pass
+
+    import cv2
+
+    def imread(filename):
+        return cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+
+    def save_masks(images, masks, flows, file_names, png=True, save_txt=False, **kwargs):
+        base = os.path.splitext(file_names)[0]
+        if masks.max() < 2**16:
+            cv2.imwrite(base + '_cp_masks.png', masks.astype(np.uint16))
+        else:
+            import tifffile
+            tifffile.imwrite(base + '_cp_masks.tif', masks.astype(np.uint32))
+
+    def smooth_sharpen_img(img, smooth_radius=6, sharpen_radius=12):
+        img = np.asarray(img, dtype=np.float32)
+        return cv2.GaussianBlur(img, (0, 0), smooth_radius) if smooth_radius else img
+
+    cellpose = types.ModuleType('cellpose')
+    cellpose.io = types.ModuleType('cellpose.io')
+    cellpose.io.imread, cellpose.io.save_masks = imread, save_masks
+    cellpose.transforms = types.ModuleType('cellpose.transforms')
+    cellpose.transforms.smooth_sharpen_img = smooth_sharpen_img
+    sys.modules.update({'cellpose': cellpose, 'cellpose.io': cellpose.io, 'cellpose.transforms': cellpose.transforms})
+    return 'stand-in'
+
+
+def git_commit():
+    """Current commit hash, with '-dirty' appended when tracked files are modified."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo, capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_runs(run, repeat, setup=None):
+    """Call run() repeat times, each after an untimed setup(), and return the wall times."""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class BenchmarkRun:
+    def __init__(self, work_dir, originals, label_counts, repeat):
+        self.work_dir = work_dir
+        self.originals = originals
+        self.label_counts = label_counts
+        self.repeat = repeat
+        self.results = {}
+        self._label_paths = {}
+
+    def record(self, name, times, **params):
+        self.results[name] = {
+            'median_s': statistics.median(times), 'min_s': min(times), 'runs': times, 'params': params
+        }
+        print(f"{name}: median {statistics.median(times):.4f} s, min {min(times):.4f} s")
+
+    def label_path(self, n_labels):
+        """Synthetic label image matching the first original, written once per label count.
+
+        A 16-bit PNG like Cellpose writes, or a 32-bit TIFF (as tiled mode writes)
+        from 65536 labels on, which PNG cannot hold.
+        """
+        import cv2
+
+        if n_labels not in self._label_paths:
+            shape = cv2.imread(self.originals[0], cv2.IMREAD_GRAYSCALE).shape
+            labels = synthetic_labels(shape, n_labels)
+            if labels.dtype == np.uint16:
+                path = os.path.join(self.work_dir, f"synthetic_{n_labels}_cp_masks.png")
+                cv2.imwrite(path, labels)
+            else:
+                import tifffile
+                path = os.path.join(self.work_dir, f"synthetic_{n_labels}_cp_masks.tif")
+                tifffile.imwrite(path, labels)
+            self._label_paths[n_labels] = path
+        return self._label_paths[n_labels]
+
+    def visualizer(self, n_labels):
+        """Fresh ROIVisualizer with its own cache, so every run includes decoding the images."""
+        from imagecache import ImageCache
+        from l2r import ROIVisualizer
+
+        return ROIVisualizer(
+            self.label_path(n_labels), self.originals[0], os.path.join(self.work_dir, f"rois_{n_labels}.xlsx"),
+            os.path.join(self.work_dir, f"overlay_{n_labels}.png"), show_labels=True, image_cache=ImageCache(), use_gpu=False
+        )
+
+    def bench_excel(self):
+        for n_labels in self.label_counts:
+            times = time_runs(lambda v: v.save_rois_to_excel(), self.repeat, lambda: (self.visualizer(n_labels),))
+            self.record(f"excel[{n_labels}]", times, labels=n_labels)
+
+    def bench_overlays(self):
+        for n_labels in self.label_counts:
+            times = time_runs(lambda v: v.create_overlays(), self.repeat, lambda: (self.visualizer(n_labels),))
+            self.record(f"overlays[{n_labels}]", times, labels=n_labels)
+
+    def bench_summary(self):
+        from imagecache import ImageCache
+        from l2r import compute_roi_stats
+        from mastersheet import genmasterSheet
+        from roiwriters import write_rois_excel
+        import cv2
+
+        # One workbook per (original, label count), read back by the summary sheet
+        sheets_dir = os.path.join(self.work_dir, 'sheets')
+        os.makedirs(sheets_dir, exist_ok=True)
+        for n_labels in self.label_counts:
+            labels = ImageCache(use_mmap=False).load_labels(self.label_path(n_labels))
+            for original in self.originals:
+                gray = cv2.imread(original, cv2.IMREAD_GRAYSCALE)
+                name = f"{pipeline.get_file_base_name(original)}_{n_labels}.xlsx"
+                write_rois_excel(compute_roi_stats(labels, gray), os.path.join(sheets_dir, name))
+
+        save_path = os.path.join(self.work_dir, 'Summary.xlsx')
+        workbooks = len(self.label_counts) * len(self.originals)
+        times = time_runs(lambda: genmasterSheet(sheets_dir, save_path, workers=1), self.repeat)
+        self.record("summary[workbooks]", times, workbooks=workbooks, labels=list(self.label_counts))
+
+    def bench_segmentation(self, n_labels=1000, batch_size=1):
+        try:
+            cellpose = install_cellpose_stand_in()
+            import segment
+        except ImportError as e:
+            print(f"Skipping segmentation: {e}")
+            return
+
+        class MockSegmenter(segment.StopFlag):
+            model = MockModel(n_labels)
+
+        def setup():
+            images_dir = os.path.join(self.work_dir, 'segmentation')
+            shutil.rmtree(images_dir, ignore_errors=True)
+            os.makedirs(images_dir)
+            files = [shutil.copy(original, images_dir) for original in self.originals]
+            return images_dir, files
+
+        times = time_runs(
+            lambda images_dir, files: MockSegmenter().segment(images_dir, diameter=30, batch_size=batch_size, files=files),
+            self.repeat, setup
+        )
+        self.record(
+            "segmentation[mock model]", times, images=len(self.originals), labels=n_labels, batch_size=batch_size, cellpose=cellpose
+        )
+
+
+def compare(results, baseline, threshold):
+    """Print current vs. baseline medians; return the names that got slower than threshold allows."""
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit')}:")
+    print(f"{'benchmark':<28}{'baseline s':>12}{'current s':>12}{'ratio':>8}")
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"{name:<28}{'-':>12}{result['median_s']:>12.4f}{'new':>8}")
+            continue
+        ratio = result['median_s'] / before['median_s'] if before['median_s'] else float('inf')
+        flag = "  slower" if ratio > threshold else ""
+        print(f"{name:<28}{before['median_s']:>12.4f}{result['median_s']:>12.4f}{ratio:>8.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark S2L stages on ExampleDataset and synthetic label images (CPU only).")
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS), help="Benchmarks to run (default: all).")
+    parser.add_argument('--labels', nargs='+', type=int, default=list(DEFAULT_LABELS),
+                        help="Label counts of the synthetic label images (default: %(default)s).")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per benchmark; the median is reported.")
+    parser.add_argument('--images', type=int, default=0, help="Use only the first N ExampleDataset images (0 = all).")
+    parser.add_argument('--output', help="Results JSON (default: bench_<commit>.json).")
+    parser.add_argument('--compare', help="Baseline results JSON to compare against.")
+    parser.add_argument('--threshold', type=float, default=1.10,
+                        help="With --compare, exit with status 1 when a median grows by more than this factor.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    originals = sorted(pipeline.find_images(EXAMPLE_DIR))
+    if args.images:
+        originals = originals[:args.images]
+    if not originals:
+        print(f"No images found in {EXAMPLE_DIR}", file=sys.stderr)
+        return 2
+
+    commit = git_commit()
+    work_dir = tempfile.mkdtemp(prefix='s2l-bench-')
+    try:
+        run = BenchmarkRun(work_dir, originals, args.labels, max(1, args.repeat))
+        for name in args.only:
+            getattr(run, f"bench_{name}")()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'repeat': run.repeat,
+        'images': [os.path.basename(path) for path in originals],
+        'results': run.results,
+    }
+    output_path = args.output or f"bench_{(commit or 'unknown')[:12]}.json"
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=1)
+    print(f"Results written to {output_path}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(run.results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than {args.threshold:.2f}x the baseline.")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import pipeline
+import profiling
+from manifest import MANIFEST_NAME, RunManifest
+
+# Heavy modules (torch, cellpose, cupy, cv2, pandas) are only imported by the
+# pipeline stages that need them, so --help and stats-only runs start quickly.
+
+STAGES = ('segment', 'rois', 'summary')
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Run S2L headless: Cellpose segmentation, Labels2ROIs and the summary sheet."
+    )
+    parser.add_argument('base_dir', help="Directory with the input images (and their *_cp_masks files).")
+    parser.add_argument('output_dir', help="Directory for ROI sheets, overlays and the summary sheet.")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help="Stages to run, in pipeline order (default: all). 'summary' without 'rois' "
+                             "summarises the workbooks already in output_dir.")
+
+    seg = parser.add_argument_group('segmentation')
+    seg.add_argument('--diameter', type=int, default=0,
+                     help="Cell diameter in pixels; 0 estimates it once from a sample of the images and reuses it.")
+    seg.add_argument('--per-image-diameter', action='store_true',
+                     help="With --diameter 0, let Cellpose estimate the diameter of every image separately (slower).")
+    seg.add_argument('--calibration-images', type=int, default=0,
+                     help="Images sampled to estimate the diameter (default: 8).")
+    seg.add_argument('--batch-size', type=int, default=1, help="Same-shape images per model.eval call.")
+    seg.add_argument('--model-type', default='cyto', help="Cellpose model type (default: cyto).")
+    seg.add_argument('--tile-size', type=int, default=0,
+                     help="Process images in tiles of this many pixels (0 = whole images). For very large images; "
+                          "also makes Labels2ROIs accumulate statistics per tile and skip overlays.")
+    seg.add_argument('--tile-overlap', type=int, default=128,
+                     help="Overlap between segmentation tiles; use at least the largest cell diameter.")
+    seg.add_argument('--keep-masks', action='store_true',
+                     help="When segmentation and Labels2ROIs run together, also write the *_cp_masks files "
+                          "(masks are otherwise passed to Labels2ROIs in memory).")
+
+    rois = parser.add_argument_group('Labels2ROIs')
+    rois.add_argument('--workers', type=int, default=1, help="Worker processes for Labels2ROIs.")
+    rois.add_argument('--render-plots', action='store_true', help="Save Matplotlib plots instead of plain overlay PNGs.")
+    rois.add_argument('--no-excel', action='store_true', help="Do not write per-image Excel sheets.")
+    rois.add_argument('--dataset', choices=('parquet', 'npz'), help="Also write a run-wide ROI dataset in this format.")
+    rois.add_argument('--excel-from-dataset', action='store_true',
+                      help="Write the per-image Excel sheets from the --dataset file as a final step "
+                           "(use with --no-excel to keep them out of the Labels2ROIs stage).")
+
+    parser.add_argument('--cpu', action='store_true', help="Do not use the GPU, even if one is available.")
+    parser.add_argument('--force', action='store_true',
+                        help=f"Redo every stage even if {MANIFEST_NAME} in output_dir says it is up to date.")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.excel_from_dataset and not args.dataset:
+        parser.error("--excel-from-dataset needs --dataset")
+    start_time = time.time()
+    failures = 0
+
+    if not os.path.isdir(args.base_dir):
+        print(f"Base directory does not exist: {args.base_dir}", file=sys.stderr)
+        return 2
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = RunManifest(os.path.join(args.output_dir, MANIFEST_NAME), force=args.force)
+    profiler = profiling.Profiler()
+
+    with profiling.activate(profiler):
+        records = None
+        if 'segment' in args.stages and 'rois' in args.stages and not args.tile_size:
+            # Masks go straight from the model to Labels2ROIs
+            errors, records, failed = pipeline.run_segmentation_with_rois(
+                args.base_dir, args.output_dir, args.diameter, batch_size=args.batch_size, model_type=args.model_type,
+                gpu=False if args.cpu else None, workers=args.workers, render_plots=args.render_plots,
+                save_excel=not args.no_excel, dataset_format=args.dataset, use_gpu=not args.cpu,
+                keep_masks=args.keep_masks, manifest=manifest, per_image_diameter=args.per_image_diameter,
+                calibration_sample_size=args.calibration_images or None
+            )
+            failures += len(errors) + len(failed)
+        elif 'segment' in args.stages:
+            errors = pipeline.run_segmentation(
+                args.base_dir, args.diameter, batch_size=args.batch_size, model_type=args.model_type,
+                gpu=False if args.cpu else None, manifest=manifest, tile_size=args.tile_size or None,
+                tile_overlap=args.tile_overlap, per_image_diameter=args.per_image_diameter,
+                calibration_sample_size=args.calibration_images or None
+            )
+            failures += len(errors)
+
+        if 'rois' in args.stages and records is None:
+            records, failed = pipeline.run_labels2rois(
+                args.base_dir, args.output_dir, workers=args.workers, render_plots=args.render_plots,
+                save_excel=not args.no_excel, dataset_format=args.dataset, use_gpu=not args.cpu, manifest=manifest,
+                tile_size=args.tile_size or None
+            )
+            failures += len(failed)
+
+        if args.excel_from_dataset:
+            records = pipeline.run_excel_export(args.output_dir, args.dataset, records)
+
+        if 'summary' in args.stages and (records is None or records):
+            pipeline.run_summary(args.output_dir, records, manifest=manifest)
+
+    json_path, csv_path = profiler.write(args.output_dir)
+    print(profiler.summary_text())
+    print(f"Timing trace written to {json_path} and {csv_path}")
+    print(f"Finished in {time.time() - start_time:.2f} seconds with {failures} failure(s).")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
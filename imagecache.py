@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+try:
+    import tifffile
+    TIFFFILE_AVAILABLE = True
+except ImportError:
+    TIFFFILE_AVAILABLE = False
+
+
+def memmap_tiff(path):
+    """Memory-map an uncompressed single-page TIFF read-only, or return None."""
+    if not TIFFFILE_AVAILABLE or not path.lower().endswith(('.tif', '.tiff')):
+        return None
+    try:
+        return tifffile.memmap(path, mode='r')
+    except Exception:
+        return None  # Compressed, tiled or otherwise not mappable
+
+
+class ImageCache:
+    """Small thread-safe LRU cache of decoded images.
+
+    Entries are keyed by path, modification time and size, so a file rewritten on
+    disk is decoded again. Cached arrays are shared between callers and marked
+    read-only. When use_mmap is set, uncompressed TIFFs are memory-mapped with
+    tifffile instead of being decoded into memory.
+    """
+
+    def __init__(self, max_items=4, use_mmap=True):
+        self.max_items = max_items
+        self.use_mmap = use_mmap and TIFFFILE_AVAILABLE
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load_labels(self, path):
+        """Return the label image as stored on disk (like cv2.IMREAD_UNCHANGED), or None."""
+        return self._get(path, 'labels', self._decode_labels)
+
+    def load_original(self, path):
+        """Return (color, gray) versions of an image, or (None, None) if it cannot be read.
+
+        color matches cv2.IMREAD_COLOR and gray matches cv2.IMREAD_GRAYSCALE. The
+        file is decoded once; gray is derived from color when the image has no
+        colour information.
+        """
+        return self._get(path, 'original', self._decode_original) or (None, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def _get(self, path, kind, decode):
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            return None
+        key = (os.path.abspath(path), kind, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        value = decode(path)
+        if value is None:
+            return None
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return value
+
+    def _memmap(self, path):
+        return memmap_tiff(path) if self.use_mmap else None
+
+    def _decode_labels(self, path):
+        label_image = self._memmap(path)
+        if label_image is None or label_image.ndim != 2:
+            label_image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        return _read_only(label_image)
+
+    def _decode_original(self, path):
+        mapped = self._memmap(path)
+        if mapped is not None and mapped.dtype == np.uint8 and mapped.ndim == 2:
+            return _read_only(cv2.cvtColor(mapped, cv2.COLOR_GRAY2BGR)), _read_only(mapped)
+        if mapped is not None and mapped.dtype == np.uint8 and mapped.ndim == 3 and mapped.shape[2] == 3:
+            color = cv2.cvtColor(mapped, cv2.COLOR_RGB2BGR)
+            return _read_only(color), _read_only(cv2.imread(path, cv2.IMREAD_GRAYSCALE))
+
+        color = cv2.imread(path, cv2.IMREAD_COLOR)
+        if color is None:
+            return None
+
+        if (color[..., 0] == color[..., 1]).all() and (color[..., 1] == color[..., 2]).all():
+            gray = np.ascontiguousarray(color[..., 0])
+        else:
+            gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)  # Keep OpenCV's own colour conversion
+        return _read_only(color), _read_only(gray)
+
+
+def color_and_gray(image):
+    """Convert an image array (as cellpose.io.imread returns it) to the (color, gray) pair load_original returns.
+
+    Returns None when the conversion would not match what OpenCV decodes from
+    the file (colour images, unusual dtypes or layouts); read the file instead.
+    """
+    if image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)  # What cv2.imread does with 16-bit images
+    elif image.dtype != np.uint8:
+        return None
+
+    if image.ndim == 3 and image.shape[2] in (3, 4) and (image[..., 0] == image[..., 1]).all() and (image[..., 1] == image[..., 2]).all():
+        image = image[..., 0]
+    if image.ndim != 2:
+        return None
+    gray = np.ascontiguousarray(image)
+    return _read_only(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)), _read_only(gray)
+
+
+def _read_only(array):
+    if array is not None:
+        array.flags.writeable = False
+    return array
+
+
+_default_cache = ImageCache()
+
+
+def default_image_cache():
+    """Return the process-wide image cache shared by the Labels2ROIs stage."""
+    return _default_cache
@@ -1,106 +1,353 @@
 import cv2
 import numpy as np
-import xlsxwriter
-import matplotlib.pyplot as plt
+import profiling
+import tiling
+from backend import NUMPY_BACKEND, get_backend
+from imagecache import default_image_cache
+from roiwriters import ROI_HEADERS, write_rois_excel
+
+
+def compute_roi_stats(label_image, intensity_image, backend=NUMPY_BACKEND):
+    """Compute statistics for every non-zero label at once.
+
+    The reductions are bincounts over the flattened label image (plus one sort
+    by label for the standard deviation on the host, see _squared_deviations),
+    so the cost grows with the number of pixels rather than labels x pixels,
+    and the values equal the per-label np.mean/np.std results. The work
+    runs on backend (see backend.get_backend) and only the finished columns are
+    copied to the host. Returns a dict mapping each of ROI_HEADERS to a NumPy
+    array with one entry per label, in ascending label order.
+    """
+    if label_image.shape[:2] != intensity_image.shape[:2]:
+        raise ValueError("Label image and original image have different sizes.")
+
+    xp = backend.xp
+    height, width = label_image.shape[:2]
+    labels_flat = backend.asarray(label_image).reshape(-1).astype(xp.int64, copy=False)
+    values = backend.asarray(intensity_image).reshape(-1).astype(xp.float64)
+    n_bins = int(labels_flat.max()) + 1 if labels_flat.size else 1
+
+    counts = xp.bincount(labels_flat, minlength=n_bins)
+    sums = xp.bincount(labels_flat, weights=values, minlength=n_bins)
+
+    labels = xp.nonzero(counts)[0]
+    labels = labels[labels > 0]  # Exclude background
+    area = counts[labels]
+
+    # Means and standard deviations in two passes, the same way np.mean/np.std compute them
+    means = xp.zeros(n_bins, dtype=xp.float64)
+    means[labels] = sums[labels] / area
+    if xp is np:
+        squared = _squared_deviations(labels_flat, values, means, labels, area)
+    else:
+        deviations = values - means[labels_flat]
+        squared = xp.bincount(labels_flat, weights=deviations * deviations, minlength=n_bins)[labels]
+
+    integrated_density = sums[labels]
+    if np.issubdtype(intensity_image.dtype, np.integer):
+        integrated_density = xp.rint(integrated_density).astype(xp.int64)
+
+    # Centroids and bounding boxes, computed from foreground pixels only
+    foreground = xp.flatnonzero(labels_flat)
+    fg_labels = labels_flat[foreground]
+    rows, cols = foreground // width, foreground % width
+
+    row_sums = xp.bincount(fg_labels, weights=rows, minlength=n_bins)
+    col_sums = xp.bincount(fg_labels, weights=cols, minlength=n_bins)
+
+    min_rows = xp.full(n_bins, height, dtype=xp.int64)
+    max_rows = xp.full(n_bins, -1, dtype=xp.int64)
+    min_cols = xp.full(n_bins, width, dtype=xp.int64)
+    max_cols = xp.full(n_bins, -1, dtype=xp.int64)
+    backend.scatter_min(min_rows, fg_labels, rows)
+    backend.scatter_max(max_rows, fg_labels, rows)
+    backend.scatter_min(min_cols, fg_labels, cols)
+    backend.scatter_max(max_cols, fg_labels, cols)
+
+    columns = backend.to_host(
+        labels,
+        area,
+        integrated_density,
+        means[labels],
+        xp.sqrt(squared / area),
+        col_sums[labels] / area,
+        row_sums[labels] / area,
+        min_cols[labels],
+        min_rows[labels],
+        max_cols[labels] - min_cols[labels] + 1,
+        max_rows[labels] - min_rows[labels] + 1,
+    )
+    return dict(zip(ROI_HEADERS, columns))
+
+def _squared_deviations(labels_flat, values, means, labels, area):
+    """Per-label sums of squared deviations from the mean, for the labels in labels.
+
+    bincount adds the squares one pixel at a time, while np.std sums each
+    label's pixels pairwise, so the two differ in the last digits. Here every
+    label's deviations are gathered into one contiguous run (in image order) and
+    summed with ndarray.sum, which gives exactly np.std(image[label_image == label]).
+    """
+    dtype = np.uint16 if labels.size and labels[-1] < 2**16 else labels_flat.dtype
+    order = np.argsort(labels_flat.astype(dtype, copy=False), kind='stable')  # Radix sort for 16-bit labels
+    order = order[labels_flat.size - int(area.sum()):]  # Drop the background, which sorts first
+    deviations = values[order] - np.repeat(means[labels], area)
+    deviations *= deviations
+    ends = np.cumsum(area)
+    return np.array([deviations[end - n:end].sum() for end, n in zip(ends.tolist(), area.tolist())], dtype=np.float64)
+
+class RoiAccumulator:
+    """Accumulate ROI statistics over the tiles of a label image.
+
+    Per-label sums grow as new labels appear, so memory depends on the tile size
+    and the number of labels, not on the image size. The standard deviation is
+    derived from running sums of squares, so it can differ from
+    compute_roi_stats in the last few digits.
+    """
+
+    def __init__(self):
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0, dtype=np.float64)
+        self.squares = np.zeros(0, dtype=np.float64)
+        self.row_sums = np.zeros(0, dtype=np.float64)
+        self.col_sums = np.zeros(0, dtype=np.float64)
+        self.min_rows = np.zeros(0, dtype=np.intp)
+        self.max_rows = np.zeros(0, dtype=np.intp)
+        self.min_cols = np.zeros(0, dtype=np.intp)
+        self.max_cols = np.zeros(0, dtype=np.intp)
+        self.integer_intensity = True
+
+    def _grow(self, n_bins):
+        extra = n_bins - len(self.count)
+        if extra <= 0:
+            return
+        for name in ('count', 'sums', 'squares', 'row_sums', 'col_sums'):
+            setattr(self, name, np.concatenate([getattr(self, name), np.zeros(extra, dtype=getattr(self, name).dtype)]))
+        largest = np.iinfo(np.intp).max
+        for name, fill in (('min_rows', largest), ('max_rows', -1), ('min_cols', largest), ('max_cols', -1)):
+            setattr(self, name, np.concatenate([getattr(self, name), np.full(extra, fill, dtype=np.intp)]))
+
+    def add_tile(self, label_tile, intensity_tile, y0=0, x0=0):
+        """Add one tile whose top-left corner is at (y0, x0) in the full image."""
+        if label_tile.shape[:2] != intensity_tile.shape[:2]:
+            raise ValueError("Label tile and original tile have different sizes.")
+        if label_tile.size == 0:
+            return
+        self.integer_intensity &= bool(np.issubdtype(intensity_tile.dtype, np.integer))
+
+        tile_width = label_tile.shape[1]
+        labels_flat = np.asarray(label_tile).reshape(-1).astype(np.intp)
+        values = np.asarray(intensity_tile).reshape(-1).astype(np.float64)
+        n_bins = int(labels_flat.max()) + 1
+        self._grow(n_bins)
+
+        self.count[:n_bins] += np.bincount(labels_flat, minlength=n_bins)
+        self.sums[:n_bins] += np.bincount(labels_flat, weights=values, minlength=n_bins)
+        self.squares[:n_bins] += np.bincount(labels_flat, weights=values * values, minlength=n_bins)
+
+        foreground = np.flatnonzero(labels_flat)
+        fg_labels = labels_flat[foreground]
+        rows, cols = np.divmod(foreground, tile_width)
+        rows += y0
+        cols += x0
+        self.row_sums[:n_bins] += np.bincount(fg_labels, weights=rows, minlength=n_bins)
+        self.col_sums[:n_bins] += np.bincount(fg_labels, weights=cols, minlength=n_bins)
+        np.minimum.at(self.min_rows, fg_labels, rows)
+        np.maximum.at(self.max_rows, fg_labels, rows)
+        np.minimum.at(self.min_cols, fg_labels, cols)
+        np.maximum.at(self.max_cols, fg_labels, cols)
+
+    def result(self):
+        """Return the statistics in the same form as compute_roi_stats."""
+        labels = np.nonzero(self.count)[0]
+        labels = labels[labels > 0]  # Exclude background
+        area = self.count[labels]
+        means = self.sums[labels] / area
+        variances = np.maximum(self.squares[labels] / area - means * means, 0)
+
+        integrated_density = self.sums[labels]
+        if self.integer_intensity:
+            integrated_density = np.rint(integrated_density).astype(np.int64)
+
+        return {
+            'Label': labels,
+            'Area': area,
+            'Integrated Density': integrated_density,
+            'Mean Gray Value': means,
+            'Standard Deviation': np.sqrt(variances),
+            'Centroid X': self.col_sums[labels] / area,
+            'Centroid Y': self.row_sums[labels] / area,
+            'BBox X': self.min_cols[labels],
+            'BBox Y': self.min_rows[labels],
+            'BBox Width': self.max_cols[labels] - self.min_cols[labels] + 1,
+            'BBox Height': self.max_rows[labels] - self.min_rows[labels] + 1,
+        }
+
+
+def compute_roi_stats_tiled(label_image, intensity_image, to_gray=np.asarray, tile_size=2048):
+    """compute_roi_stats over tiles of (possibly memory-mapped) images, with bounded memory.
+
+    to_gray converts each intensity tile before it is measured (see tiling.open_gray).
+    """
+    if label_image.shape[:2] != intensity_image.shape[:2]:
+        raise ValueError("Label image and original image have different sizes.")
+
+    accumulator = RoiAccumulator()
+    height, width = label_image.shape[:2]
+    for y0, x0 in tiling.tile_origins(height, width, tile_size):
+        y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+        accumulator.add_tile(np.asarray(label_image[y0:y1, x0:x1]), to_gray(intensity_image[y0:y1, x0:x1]), y0, x0)
+    return accumulator.result()
+
+
+def color_labels(label_image, backend=NUMPY_BACKEND):
+    """Color every label with a random color and locate the label centroids.
+
+    Colors are applied with a single lookup-table index over the whole label
+    image and centroids come from one bincount reduction, so the work does not
+    grow with the number of labels. Returns arrays of the backend's array
+    module: the BGR overlay, the non-zero labels and their integer (x, y)
+    centroids.
+    """
+    xp = backend.xp
+    label_image = backend.asarray(label_image)
+    height, width = label_image.shape[:2]
+    labels_flat = label_image.reshape(-1).astype(xp.int64)
+    n_bins = int(labels_flat.max()) + 1 if labels_flat.size else 1
+
+    counts = xp.bincount(labels_flat, minlength=n_bins)
+    labels = xp.nonzero(counts)[0]
+    labels = labels[labels > 0]  # Exclude background
+
+    lut = xp.zeros((n_bins, 3), dtype=xp.uint8)
+    lut[labels] = xp.random.randint(0, 256, (len(labels), 3), dtype=xp.uint8)
+    overlay = lut[label_image]
+
+    pixel_index = xp.arange(labels_flat.size, dtype=xp.int64)
+    row_sums = xp.bincount(labels_flat, weights=pixel_index // width, minlength=n_bins)
+    col_sums = xp.bincount(labels_flat, weights=pixel_index % width, minlength=n_bins)
+    area = counts[labels]
+    centroids = xp.stack([(col_sums[labels] / area).astype(xp.int64), (row_sums[labels] / area).astype(xp.int64)], axis=1)
+    return overlay, labels, centroids
+
+
+def render_overlays(label_image, original_image, backend=NUMPY_BACKEND, alpha=0.2):
+    """Color the labels and blend them over the original on backend, then copy the results to the host.
+
+    Returns NumPy arrays: the colored label overlay, the blend (original weighted
+    by alpha), the non-zero labels and their (x, y) centroids.
+    """
+    overlay, labels, centroids = color_labels(label_image, backend)
+    blended = backend.blend(backend.asarray(original_image), alpha, overlay, 1 - alpha)
+    return backend.to_host(overlay, blended, labels, centroids)
 
-try:
-    import cupy as cp
 
-    def check_cuda():
-        try:
-            devices = cp.cuda.runtime.getDeviceCount()
-            return devices > 0
-        except cp.cuda.runtime.CUDARuntimeError:
-            return False
+class ROIVisualizer:
+    """Overlays and ROI statistics for one label image and its original.
 
-    CUPY_AVAILABLE = check_cuda()
-except ImportError:
-    CUPY_AVAILABLE = False
+    The images are read from label_image_path and original_image_path through the
+    image cache, unless label_image and original_image are given in memory
+    (original_image as the (color, gray) pair ImageCache.load_original returns).
+    With use_gpu, the work runs on the GPU when CuPy finds a device and on NumPy
+    otherwise (see backend.get_backend).
+    """
 
-class ROIVisualizer:
-    def __init__(self, label_image_path, original_image_path, excel_output_path, plot_output_path, show_labels=False, progress_callback=None):
+    def __init__(self, label_image_path, original_image_path, excel_output_path, plot_output_path, show_labels=False,
+                 progress_callback=None, image_cache=None, use_gpu=True, label_image=None, original_image=None):
         self.label_image_path = label_image_path
         self.original_image_path = original_image_path
+        self.label_image = label_image
+        self.original_image = original_image
         self.excel_output_path = excel_output_path
         self.plot_output_path = plot_output_path
         self.label_rois = show_labels
         self.zoom_factor = 1.0
         self.zoom_center = (0.5, 0.5)
         self.progress_callback = progress_callback
-        self.setup_plot()
+        self.image_cache = image_cache or default_image_cache()
+        self.use_gpu = use_gpu
+        self.backend = get_backend(use_gpu)
+        self._device_arrays = {}
+        self.fig = None
+        self.ax = None
 
     def setup_plot(self):
-        """Set up the Matplotlib figure."""
-        self.fig, self.ax = plt.subplots(figsize=(10, 10))
-        plt.subplots_adjust(left=0.1, bottom=0.1)
+        """Set up the Matplotlib figure and draw the plot."""
+        # Imported here so statistics-only runs never load Matplotlib. The figure is
+        # created without pyplot, so it is not kept alive by pyplot's figure registry.
+        from matplotlib.figure import Figure
+
+        self.close()
+        self.fig = Figure(figsize=(10, 10))
+        self.ax = self.fig.subplots()
+        self.fig.subplots_adjust(left=0.1, bottom=0.1)
         self.update_plot()
 
+    def render_plot(self):
+        """Render the Matplotlib plot to plot_output_path and release the figure."""
+        if not hasattr(self, 'roi_image'):
+            self.create_overlays()
+        with profiling.stage('plot', self.original_image_path):
+            try:
+                self.setup_plot()
+            finally:
+                self.close()
+
+    def save_overlay_image(self, output_path=None):
+        """Write the overlay at native resolution with OpenCV, without Matplotlib."""
+        if not hasattr(self, 'roi_image'):
+            self.create_overlays()
+
+        image_to_save = self.combined_image if self.label_rois else self.roi_image
+        output_path = output_path or self.plot_output_path
+        with profiling.stage('overlay_write', self.original_image_path):
+            if not cv2.imwrite(output_path, image_to_save):
+                raise ValueError(f"Unable to write overlay image to {output_path}")
+
+    def close(self):
+        """Release the Matplotlib figure, if one was created."""
+        if self.fig is not None:
+            self.fig.clear()
+            self.fig = None
+            self.ax = None
+
+    def load_images(self):
+        """Return (label image, color original, gray original), from memory or through the image cache."""
+        with profiling.stage('load_images', self.original_image_path):
+            label_image = self.label_image
+            if label_image is None:
+                label_image = self.image_cache.load_labels(self.label_image_path)
+            color, gray = self.original_image if self.original_image is not None else self.image_cache.load_original(self.original_image_path)
+        return label_image, color, gray
+
+    def _on_device(self, name, array):
+        """Array moved to the backend once per visualizer, so overlays and statistics share the upload."""
+        if name not in self._device_arrays:
+            self._device_arrays[name] = self.backend.asarray(array)
+        return self._device_arrays[name]
+
     def create_overlays(self):
         """Create overlay images with and without labels."""
-        label_image = cv2.imread(self.label_image_path, cv2.IMREAD_UNCHANGED)
-        original_image = cv2.imread(self.original_image_path, cv2.IMREAD_COLOR)
+        label_image, original_image, _ = self.load_images()
 
         if label_image is None or original_image is None:
             raise ValueError("One or both images could not be loaded. Check the file paths.")
 
-        if CUPY_AVAILABLE:
-            label_image_cp = cp.asarray(label_image)
-            original_image_cp = cp.asarray(original_image)
-
-            unique_labels = cp.unique(label_image_cp)
-            unique_labels = unique_labels[unique_labels > 0]  # Exclude background
-
-            colors = cp.random.randint(0, 256, (len(unique_labels), 3), dtype=cp.uint8)
-
-            overlay_image_cp = cp.zeros_like(original_image_cp)
-            label_overlay_cp = cp.zeros_like(original_image_cp)
-
-            for idx, label in enumerate(unique_labels.get()):
-                mask = (label_image_cp == label)
-                overlay_image_cp[mask] = colors[idx]
-                label_overlay_cp[mask] = colors[idx]
-
-            # Convert label_overlay_cp to NumPy once after all operations
-            label_overlay_np = cp.asnumpy(label_overlay_cp)
-            for idx, label in enumerate(unique_labels.get()):
-                mask = (label_image_cp == label).get()
-                coords = np.nonzero(mask)
-                if coords[0].size > 0:
-                    center_y, center_x = int(np.mean(coords[0])), int(np.mean(coords[1]))
-                    cv2.putText(label_overlay_np, str(label), (center_x, center_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
-
-            self.roi_image = cp.asnumpy(overlay_image_cp)
-            self.label_roi_image = label_overlay_np
-        else:
-            unique_labels = np.unique(label_image)
-            unique_labels = unique_labels[unique_labels > 0]
-
-            colors = np.random.randint(0, 256, (len(unique_labels), 3), dtype=np.uint8)
-
-            overlay_image_np = np.zeros_like(original_image)
-            label_overlay_np = np.zeros_like(original_image)
-
-            for idx, label in enumerate(unique_labels):
-                mask = (label_image == label)
-                overlay_image_np[mask] = colors[idx]
-                label_overlay_np[mask] = colors[idx]
-
-            # Add text labels in a single pass
-            for idx, label in enumerate(unique_labels):
-                mask = (label_image == label)
-                coords = np.nonzero(mask)
-                if coords[0].size > 0:
-                    center_y, center_x = int(np.mean(coords[0])), int(np.mean(coords[1]))
-                    cv2.putText(label_overlay_np, str(label), (center_x, center_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+        with profiling.stage('overlay', self.original_image_path) as trace:
+            self.roi_image, self.combined_image, labels, centroids = render_overlays(
+                self._on_device('labels', label_image), original_image, self.backend
+            )
 
-            self.roi_image = overlay_image_np
-            self.label_roi_image = label_overlay_np
-
-        alpha = 0.2
-        self.combined_image = cv2.addWeighted(original_image, alpha, self.label_roi_image, 1 - alpha, 0)
+            # Text is drawn on the host; centroids were computed in one reduction above
+            for label, (center_x, center_y) in zip(labels.tolist(), centroids.tolist()):
+                cv2.putText(self.combined_image, str(label), (center_x, center_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+            trace['rois'] = len(labels)
 
     def update_plot(self):
         """Update the plot with or without ROI labels based on the label_rois attribute."""
+        if self.fig is None:
+            self.setup_plot()
+            return
+
         # Create overlays if they haven't been created yet
         if not hasattr(self, 'roi_image'):
             self.create_overlays()
@@ -122,39 +369,83 @@ class ROIVisualizer:
 
         self.fig.savefig(self.plot_output_path, dpi=300)
 
-    def save_rois_to_excel(self):
-        """Save ROI information to an Excel spreadsheet."""
-        label_image = cv2.imread(self.label_image_path, cv2.IMREAD_UNCHANGED)
-        original_image = cv2.imread(self.original_image_path, cv2.IMREAD_GRAYSCALE)
+    def compute_rois(self):
+        """Compute (once) and return the ROI statistics of the label image."""
+        if not hasattr(self, 'roi_stats'):
+            label_image, _, original_image = self.load_images()
 
-        if label_image is None or original_image is None:
-            raise ValueError("Unable to load image(s) at provided path(s).")
+            if label_image is None or original_image is None:
+                raise ValueError("Unable to load image(s) at provided path(s).")
 
-        unique_labels = np.unique(label_image)
-        unique_labels = unique_labels[unique_labels > 0]
+            with profiling.stage('roi_stats', self.original_image_path) as trace:
+                self.roi_stats = compute_roi_stats(self._on_device('labels', label_image), original_image, self.backend)
+                trace['rois'] = len(self.roi_stats['Label'])
+        return self.roi_stats
 
-        roi_data = []
+    def save_rois_to_excel(self):
+        """Save ROI information to an Excel spreadsheet and return the statistics."""
+        stats = self.compute_rois()
+        with profiling.stage('excel_write', self.original_image_path):
+            write_rois_excel(stats, self.excel_output_path)
+        print(f"ROI information saved to {self.excel_output_path}")
 
-        for label in unique_labels:
-            mask = label_image == label
-            area = np.sum(mask)
-            integrated_density = np.sum(original_image[mask])
-            mean_value = np.mean(original_image[mask])
-            std_dev = np.std(original_image[mask])
-            roi_data.append([label, area, integrated_density, mean_value, std_dev])
+        # Call progress callback with 100% completion after saving
+        if self.progress_callback:
+            self.progress_callback(100)
 
-        # Save to Excel using xlsxwriter
-        with xlsxwriter.Workbook(self.excel_output_path) as workbook:
-            worksheet = workbook.add_worksheet()
+        return stats
 
-            headers = ['Label', 'Area', 'Integrated Density', 'Mean Gray Value', 'Standard Deviation']
-            worksheet.write_row(0, 0, headers)
 
-            for row, data in enumerate(roi_data, start=1):
-                worksheet.write_row(row, 0, data)
+def process_mask(label_image_path, original_image_path, excel_output_path, plot_output_path, show_labels=True, render_plot=False,
+                 save_excel=True, return_stats=False, use_gpu=True, tile_size=None, label_image=None, original_image=None):
+    """Run Labels2ROIs for one mask: write the overlay (or Matplotlib plot) and the ROI sheet.
 
-        print(f"ROI information saved to {self.excel_output_path}")
+    Defined at module level so it can be submitted to a process pool. Returns the
+    summary row for the master sheet: (file location, number of objects, sum of
+    integrated density). The file location is the Excel sheet, or the original
+    image when save_excel is off. With return_stats, returns (row, stats) so the
+    caller can append the ROI table to a run-wide dataset.
 
-        # Call progress callback with 100% completion after saving
-        if self.progress_callback:
-            self.progress_callback(100)
+    label_image and original_image are passed to ROIVisualizer, so masks coming
+    straight from segmentation need no mask file.
+
+    With tile_size set, statistics are accumulated tile by tile from memory-mapped
+    images and no overlay or plot is written, so very large images fit in memory.
+    """
+    if tile_size:
+        label_image = tiling.open_labels(label_image_path)
+        intensity_image, to_gray = tiling.open_gray(original_image_path)
+        if label_image is None or intensity_image is None:
+            raise ValueError("Unable to load image(s) at provided path(s).")
+
+        with profiling.stage('roi_stats', original_image_path) as trace:
+            stats = compute_roi_stats_tiled(label_image, intensity_image, to_gray, tile_size)
+            trace['rois'] = len(stats['Label'])
+        if save_excel:
+            with profiling.stage('excel_write', original_image_path):
+                write_rois_excel(stats, excel_output_path)
+            print(f"ROI information saved to {excel_output_path}")
+        record = summarize_roi_stats(excel_output_path if save_excel else original_image_path, stats)
+        return (record, stats) if return_stats else record
+
+    visualizer = ROIVisualizer(label_image_path, original_image_path, excel_output_path, plot_output_path, show_labels=show_labels, use_gpu=use_gpu,
+                               label_image=label_image, original_image=original_image)
+    if render_plot:
+        visualizer.render_plot()
+    else:
+        visualizer.save_overlay_image()
+
+    if save_excel:
+        stats = visualizer.save_rois_to_excel()
+        record = summarize_roi_stats(excel_output_path, stats)
+    else:
+        stats = visualizer.compute_rois()
+        record = summarize_roi_stats(original_image_path, stats)
+    return (record, stats) if return_stats else record
+
+
+def summarize_roi_stats(file_location, stats):
+    """Summary row for one image: (file_location, last label, sum of integrated density)."""
+    labels = stats['Label']
+    number_of_objects = int(labels[-1]) if len(labels) else 0
+    return file_location, number_of_objects, stats['Integrated Density'].sum().item()
@@ -1,17 +1,16 @@
 import sys
 import os
-import cupy
+import multiprocessing
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QFileDialog, QLabel, QLineEdit, QPushButton, 
-    QCheckBox, QSpinBox, QProgressBar, QVBoxLayout, QWidget, QHBoxLayout, QMessageBox
+    QCheckBox, QSpinBox, QProgressBar, QVBoxLayout, QWidget, QHBoxLayout, QMessageBox, QComboBox
 )
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 from PyQt6.QtGui import QPixmap
-import l2r
-from segment import StopFlag as Cellpose
-from mastersheet import genmasterSheet
+import pipeline
+import profiling
+from manifest import MANIFEST_NAME, RunManifest
 from PIL import Image
-import re
 
 # Helper functions
 def get_image_format(file_path):
@@ -26,107 +25,109 @@ def get_image_format(file_path):
 def check_cuda_availability():
     """Check if CUDA Toolkit is available using cupy."""
     try:
+        import cupy
         return cupy.is_available()
     except Exception as e:
         print(f"Error checking CUDA availability: {e}")
         return False
 
+def format_throughput(stage, rate, eta):
+    """Status line such as 'Segmentation: 2.31 images/s, about 0:42 left'."""
+    if not rate:
+        return f"{stage}: starting..."
+    minutes, seconds = divmod(int(round(eta or 0)), 60)
+    hours, minutes = divmod(minutes, 60)
+    remaining = f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+    return f"{stage}: {rate:.2f} images/s, about {remaining} left"
+
 class WorkerThread(QThread):
     cellpose_progress = pyqtSignal(float)
     labels2rois_progress = pyqtSignal(float)
+    status = pyqtSignal(str)
+    profile_summary = pyqtSignal(str)
     finished = pyqtSignal()
 
-    def __init__(self, base_dir, output_dir, diameter, run_segmentation, run_labels2rois):
+    def __init__(self, base_dir, output_dir, diameter, run_segmentation, run_labels2rois, batch_size=1, render_plots=False, l2r_workers=1,
+                 dataset_format=None, save_excel=True, incremental=True, tile_size=0, keep_masks=False, per_image_diameter=False):
         super().__init__()
         self.base_dir = base_dir
         self.output_dir = output_dir
         self.diameter = diameter
+        self.batch_size = batch_size
+        self.render_plots = render_plots
+        self.l2r_workers = max(1, l2r_workers)
+        self.dataset_format = dataset_format
+        self.save_excel = save_excel
+        self.incremental = incremental
+        self.tile_size = tile_size or None
+        self.keep_masks = keep_masks
+        self.per_image_diameter = per_image_diameter
         self.run_segmentation = run_segmentation
         self.run_labels2rois = run_labels2rois
-        self.cellpose = Cellpose()  # Initialize Cellpose class
+        self.stop = False  # Checked between stages and by Labels2ROIs (see cancel)
+        self.segmenter = None
+
+    def cancel(self):
+        """Ask the run to stop after the images in progress; called from the UI thread."""
+        self.stop = True
+        if self.segmenter is not None:
+            self.segmenter.stop = True
 
     def run(self):
+        # The manifest lives in the output directory and always records results;
+        # with "Skip Up-To-Date Files" unchecked nothing is skipped.
+        manifest = RunManifest(os.path.join(self.output_dir, MANIFEST_NAME), force=not self.incremental)
+        profiler = profiling.Profiler()
+
+        # With both steps, masks go straight from the model to Labels2ROIs instead of through mask files
+        handoff = self.run_segmentation and self.run_labels2rois and not self.tile_size
+        records, failed = None, []
+
         if self.run_segmentation:
-            print(f"Running segmentation in directory: {self.base_dir}")
-            self.cellpose.segment(self.base_dir, diameter=int(self.diameter), progress_callback=self.update_cellpose_progress)
-        
-        if self.run_labels2rois:
-            masks = [os.path.join(self.base_dir, f) for f in os.listdir(self.base_dir) if "cp_masks" in f]
-            total_masks = len(masks)
-            print(f"Found {total_masks} masks for processing.")
-
-            if total_masks == 0:
-                self.labels2rois_progress.emit(100)  # If no masks, set progress to 100%
-                return
-
-            self.labels2rois_progress.emit(0)  # Initialize Labels2ROIs progress to 0
-            for idx, mask in enumerate(masks):
-                print(f"Processing mask file: {mask}")
-                
-                # Determine paths
-                label_image_path = mask
-                original_image_path = self.get_original_image_path(mask)
-                plot_output_path = os.path.join(self.output_dir, f"{self.get_file_base_name(mask)}_ROI.png")
-                excel_output_path = os.path.join(self.output_dir, f"{self.get_file_base_name(mask)}.xlsx")
-
-                print(f"Original image path: {original_image_path}")
-                print(f"Plot output path: {plot_output_path}")
-                print(f"Excel output path: {excel_output_path}")
-                
-                if not os.path.exists(original_image_path):
-                    print(f"Error: Original image file does not exist: {original_image_path}")
-                    continue
-                
-                visualizer = l2r.ROIVisualizer(
-                    label_image_path, original_image_path, excel_output_path, plot_output_path, 
-                    show_labels=True, progress_callback=self.update_labels2rois_progress
+            # Imported here, off the UI thread: this loads torch and Cellpose. The
+            # model itself is only loaded when the first image reaches it.
+            from segment import StopFlag
+            self.segmenter = StopFlag()
+            self.segmenter.stop = self.stop
+
+        with profiling.activate(profiler):
+            if handoff:
+                _, records, failed = pipeline.run_segmentation_with_rois(
+                    self.base_dir, self.output_dir, self.diameter, batch_size=self.batch_size, segmenter=self.segmenter, workers=self.l2r_workers,
+                    render_plots=self.render_plots, save_excel=self.save_excel, dataset_format=self.dataset_format,
+                    keep_masks=self.keep_masks, manifest=manifest, segmentation_progress=self.update_cellpose_progress,
+                    rois_progress=self.update_labels2rois_progress, per_image_diameter=self.per_image_diameter
+                )
+            elif self.run_segmentation:
+                pipeline.run_segmentation(
+                    self.base_dir, self.diameter, batch_size=self.batch_size, segmenter=self.segmenter,
+                    progress_callback=self.update_cellpose_progress, manifest=manifest, tile_size=self.tile_size,
+                    per_image_diameter=self.per_image_diameter
                 )
-                visualizer.save_rois_to_excel()
 
-                # Update progress after each mask processed
-                self.labels2rois_progress.emit(((idx + 1) / total_masks) * 100)
+            if self.run_labels2rois and not handoff and not self.stop:
+                records, failed = pipeline.run_labels2rois(
+                    self.base_dir, self.output_dir, workers=self.l2r_workers, render_plots=self.render_plots,
+                    save_excel=self.save_excel, dataset_format=self.dataset_format,
+                    progress_callback=self.update_labels2rois_progress, manifest=manifest, tile_size=self.tile_size,
+                    stop_flag=self
+                )
 
-            summary_dir = os.path.join(self.output_dir, "SummarySheet")
-            os.makedirs(summary_dir, exist_ok=True)
-            master_excel_save_path = os.path.join(summary_dir, "Summary.xlsx")
-            genmasterSheet(directory=self.output_dir, savePath=master_excel_save_path)
+            if self.run_labels2rois and (records or failed) and not self.stop:
+                pipeline.run_summary(self.output_dir, records, manifest=manifest)
 
+        json_path, _ = profiler.write(self.output_dir)
+        print(f"Timing trace written to {json_path}")
+        self.profile_summary.emit(profiler.summary_text())
         self.finished.emit()
 
-    def get_original_image_path(self, mask_path):
-        """Generate the path for the original image based on the mask path."""
-        # Extract the base name of the mask file
-        mask_base_name = self.get_file_base_name(mask_path)
-        
-        # Generate possible patterns to match
-        pattern = re.sub(r'_cp_masks$', '', mask_base_name)  # Remove '_cp_masks' to find the pattern
-        
-        original_image_path = None
-        for root, dirs, files in os.walk(self.base_dir):
-            for file in files:
-                if pattern in file:
-                    possible_path = os.path.join(root, file)
-                    # Check if it's a supported image format
-                    if possible_path.lower().endswith(('.tif', '.tiff', '.png', '.jpg', '.jpeg')):
-                        original_image_path = possible_path
-                        break
-            if original_image_path:
-                break
-
-        if not original_image_path:
-            print(f"Warning: Original image not found for mask file: {mask_path}")
-
-        return original_image_path
-
-    def get_file_base_name(self, file_path):
-        """Get the base name of the file without extension."""
-        return os.path.splitext(os.path.basename(file_path))[0]
-
-    def update_cellpose_progress(self, progress):
+    def update_cellpose_progress(self, progress, rate=None, eta=None):
         self.cellpose_progress.emit(progress)
+        self.status.emit(format_throughput("Segmentation", rate, eta))
 
-    def update_labels2rois_progress(self, progress):
+    def update_labels2rois_progress(self, progress, rate=None, eta=None):
         self.labels2rois_progress.emit(progress)
+        self.status.emit(format_throughput("Labels2ROIs", rate, eta))
 
 class ImageSegmentationApp(QMainWindow):
     def __init__(self):
@@ -135,6 +136,8 @@ class ImageSegmentationApp(QMainWindow):
         self.base_dir = ''
         self.output_dir = ''
         self.diameter = 0
+        self.batch_size = 1
+        self.l2r_workers = 1
         self.image_list = []
         self.image_index = 0
         self.cuda_available = check_cuda_availability()
@@ -167,17 +170,64 @@ class ImageSegmentationApp(QMainWindow):
         self.labels2rois_checkbox = QCheckBox("Run Label to ROI")
         layout.addWidget(self.segmentation_checkbox)
         layout.addWidget(self.labels2rois_checkbox)
+        self.incremental_checkbox = QCheckBox("Skip Up-To-Date Files (Resume Previous Run)")
+        self.incremental_checkbox.setChecked(True)
+        layout.addWidget(self.incremental_checkbox)
+        self.render_plots_checkbox = QCheckBox("Save Matplotlib ROI Plots (slower)")
+        layout.addWidget(self.render_plots_checkbox)
+        self.save_excel_checkbox = QCheckBox("Write Per-Image Excel Sheets")
+        self.save_excel_checkbox.setChecked(True)
+        layout.addWidget(self.save_excel_checkbox)
+        self.keep_masks_checkbox = QCheckBox("Keep Mask Files When Running Both Steps")
+        layout.addWidget(self.keep_masks_checkbox)
+
+        # Run-wide ROI dataset; the item data is the roiwriters.DATASET_FORMATS key
+        self.dataset_format_combo = QComboBox()
+        self.dataset_format_combo.addItem("None", None)
+        self.dataset_format_combo.addItem("Parquet (.parquet)", 'parquet')
+        self.dataset_format_combo.addItem("NumPy (.npz)", 'npz')
+        layout.addWidget(QLabel("ROI Dataset Format:"))
+        layout.addWidget(self.dataset_format_combo)
         
         self.diameter_spinbox = QSpinBox()
         self.diameter_spinbox.setRange(0, 100)
         self.diameter_spinbox.setValue(0)
         self.diameter_spinbox.valueChanged.connect(self.update_diameter)
-        layout.addWidget(QLabel("Cellpose Diameter:"))
+        layout.addWidget(QLabel("Cellpose Diameter (0 = estimate once from a sample of images):"))
         layout.addWidget(self.diameter_spinbox)
+        self.per_image_diameter_checkbox = QCheckBox("Estimate Diameter Per Image (slower)")
+        layout.addWidget(self.per_image_diameter_checkbox)
+
+        self.batch_size_spinbox = QSpinBox()
+        self.batch_size_spinbox.setRange(1, 64)
+        self.batch_size_spinbox.setValue(1)
+        self.batch_size_spinbox.valueChanged.connect(self.update_batch_size)
+        layout.addWidget(QLabel("Segmentation Batch Size:"))
+        layout.addWidget(self.batch_size_spinbox)
+
+        self.tile_size_spinbox = QSpinBox()
+        self.tile_size_spinbox.setRange(0, 16384)
+        self.tile_size_spinbox.setSingleStep(512)
+        self.tile_size_spinbox.setValue(0)
+        layout.addWidget(QLabel("Tile Size for Very Large Images (0 = off):"))
+        layout.addWidget(self.tile_size_spinbox)
+
+        self.l2r_workers_spinbox = QSpinBox()
+        self.l2r_workers_spinbox.setRange(1, os.cpu_count() or 1)
+        self.l2r_workers_spinbox.setValue(1)
+        self.l2r_workers_spinbox.valueChanged.connect(self.update_l2r_workers)
+        layout.addWidget(QLabel("Labels2ROIs Worker Processes:"))
+        layout.addWidget(self.l2r_workers_spinbox)
         
-        run_button = QPushButton("Run Process")
-        run_button.clicked.connect(self.run_process)
-        layout.addWidget(run_button)
+        run_buttons_layout = QHBoxLayout()
+        self.run_button = QPushButton("Run Process")
+        self.run_button.clicked.connect(self.run_process)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_process)
+        run_buttons_layout.addWidget(self.run_button)
+        run_buttons_layout.addWidget(self.cancel_button)
+        layout.addLayout(run_buttons_layout)
         
         # Progress bars
         self.cellpose_progress_bar = QProgressBar()
@@ -186,6 +236,8 @@ class ImageSegmentationApp(QMainWindow):
         layout.addWidget(self.cellpose_progress_bar)
         layout.addWidget(QLabel("Labels2ROIs Progress:"))
         layout.addWidget(self.labels2rois_progress_bar)
+        self.status_label = QLabel("")
+        layout.addWidget(self.status_label)
         
         # CUDA Status Label
         self.cuda_status_label = QLabel("CUDA is detected." if self.cuda_available else "CUDA is not detected.")
@@ -215,6 +267,12 @@ class ImageSegmentationApp(QMainWindow):
     def update_diameter(self):
         self.diameter = self.diameter_spinbox.value()
         
+    def update_batch_size(self):
+        self.batch_size = self.batch_size_spinbox.value()
+
+    def update_l2r_workers(self):
+        self.l2r_workers = self.l2r_workers_spinbox.value()
+
     def run_process(self):
         if not self.base_dir or not self.output_dir:
             QMessageBox.warning(self, "Input Error", "Please select both base and output directories.")
@@ -223,23 +281,58 @@ class ImageSegmentationApp(QMainWindow):
         self.worker_thread = WorkerThread(
             self.base_dir, self.output_dir, self.diameter,
             self.segmentation_checkbox.isChecked(),
-            self.labels2rois_checkbox.isChecked()
+            self.labels2rois_checkbox.isChecked(),
+            batch_size=self.batch_size,
+            render_plots=self.render_plots_checkbox.isChecked(),
+            l2r_workers=self.l2r_workers,
+            dataset_format=self.dataset_format_combo.currentData(),
+            save_excel=self.save_excel_checkbox.isChecked(),
+            incremental=self.incremental_checkbox.isChecked(),
+            tile_size=self.tile_size_spinbox.value(),
+            keep_masks=self.keep_masks_checkbox.isChecked(),
+            per_image_diameter=self.per_image_diameter_checkbox.isChecked()
         )
         self.worker_thread.cellpose_progress.connect(self.update_cellpose_progress)
         self.worker_thread.labels2rois_progress.connect(self.update_labels2rois_progress)
+        self.worker_thread.status.connect(self.status_label.setText)
+        self.profile_text = ""
+        self.worker_thread.profile_summary.connect(self.set_profile_summary)
         self.worker_thread.finished.connect(self.process_finished)
+        self.run_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
         self.worker_thread.start()
 
+    def cancel_process(self):
+        """Stop the run cooperatively: images already being processed still finish."""
+        self.worker_thread.cancel()
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText("Cancelling after the images in progress...")
+
     def update_cellpose_progress(self, progress):
-        self.cellpose_progress_bar.setValue(progress)
+        self.cellpose_progress_bar.setValue(int(progress))
 
     def update_labels2rois_progress(self, progress):
-        self.labels2rois_progress_bar.setValue(progress)
+        self.labels2rois_progress_bar.setValue(int(progress))
+
+    def set_profile_summary(self, text):
+        self.profile_text = text
 
     def process_finished(self):
-        QMessageBox.information(self, "Process Complete", "The image processing is complete.")
+        self.run_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        if self.worker_thread.stop:
+            self.status_label.setText("Cancelled.")
+            QMessageBox.information(self, "Process Cancelled", "The run was cancelled. Run it again to resume where it stopped.")
+            return
+
+        self.status_label.setText("Done.")
+        message = "The image processing is complete."
+        if self.profile_text:
+            message += f"\n\nTime per stage (full trace in {profiling.TRACE_NAME}.json/.csv):\n{self.profile_text}"
+        QMessageBox.information(self, "Process Complete", message)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Needed for the Labels2ROIs process pool in frozen executables
     app = QApplication(sys.argv)
     window = ImageSegmentationApp()
     window.show()
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import time
+
+MANIFEST_NAME = "s2l_manifest.json"
+MANIFEST_VERSION = 1
+
+
+class RunManifest:
+    """Record of what each pipeline stage produced, used to skip up-to-date work.
+
+    For every stage and item (an image, a mask, the summary) the manifest stores
+    the content hashes of the inputs, the parameters and the output paths. An
+    item is up to date when all three still match and the outputs exist. The
+    manifest is saved as items complete (at most every save_interval seconds),
+    so an interrupted run resumes where it stopped.
+
+    File hashes are cached by path, size and modification time, so unchanged
+    files are not re-read on every run. With force set nothing counts as up to
+    date, but results are still recorded for the next run.
+    """
+
+    def __init__(self, path, save_interval=5.0, force=False):
+        self.path = path
+        self.force = force
+        self.save_interval = save_interval
+        self._last_save = time.time()
+        self._dirty = False
+        self.data = {'version': MANIFEST_VERSION, 'hashes': {}, 'stages': {}}
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == MANIFEST_VERSION:
+                    self.data = data
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {path}: {e}")
+
+    def file_hash(self, path):
+        """SHA-1 of a file's contents, reusing the cached value while size and mtime are unchanged."""
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.data['hashes'].get(key)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha1']
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        self.data['hashes'][key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': digest.hexdigest()}
+        self._dirty = True
+        return digest.hexdigest()
+
+    def input_hashes(self, paths):
+        return {os.path.abspath(path): self.file_hash(path) for path in paths}
+
+    def entry(self, stage, key):
+        return self.data['stages'].get(stage, {}).get(os.path.abspath(key))
+
+    def is_current(self, stage, key, inputs, params):
+        """True when stage already produced key from the same input contents and parameters."""
+        entry = self.entry(stage, key)
+        if self.force or entry is None or entry['params'] != _jsonable(params):
+            return False
+        if not all(os.path.exists(output) for output in entry['outputs']):
+            return False
+        try:
+            return entry['inputs'] == self.input_hashes(inputs)
+        except OSError:
+            return False
+
+    def record(self, stage, key, inputs, params, outputs, extra=None):
+        """Mark key as done for stage; extra holds stage-specific results (e.g. summary rows)."""
+        self.data['stages'].setdefault(stage, {})[os.path.abspath(key)] = {
+            'inputs': self.input_hashes(inputs),
+            'params': _jsonable(params),
+            'outputs': [os.path.abspath(output) for output in outputs],
+            'extra': _jsonable(extra),
+        }
+        self._dirty = True
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    def forget(self, stage, key):
+        if self.data['stages'].get(stage, {}).pop(os.path.abspath(key), None) is not None:
+            self._dirty = True
+
+    def save(self):
+        """Write the manifest atomically, so an interrupted save never corrupts it."""
+        if not self._dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        self._last_save = time.time()
+
+
+def _jsonable(value):
+    """Round-trip through JSON so tuples and NumPy scalars compare equal to what is loaded back."""
+    return json.loads(json.dumps(value, default=lambda o: o.item() if hasattr(o, 'item') else str(o)))
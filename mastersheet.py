@@ -1,43 +1,58 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from openpyxl import load_workbook
+import profiling
+from pipeline import worker_context
 
-def genmasterSheet(directory, savePath):
-    results = []
-
-    # Scan all files in the directory
-    for filename in os.listdir(directory):
-        if filename.endswith('.xlsx') or filename.endswith('.xls'):
-            # Construct the full file path
-            file_path = os.path.join(directory, filename)
-            
-            # Load the workbook
-            wb = load_workbook(file_path)
-            
-            # Select the active worksheet
-            ws = wb.active
-            
-            # Initialize the sum with the second value of the third column
-            sum_values = ws.cell(row=2, column=3).value
-            
-            # Iterate over the rest of the values in the third column
-            for i in range(3, ws.max_row + 1):
-                sum_values += ws.cell(row=i, column=3).value
-            
-            # Extract the last value in column A that contains a value
-            df = pd.read_excel(file_path)
-            last_value_in_A = df['Label'].dropna().iloc[-1]
-            
-            # Create a new DataFrame with the desired column order
-            results.append(pd.DataFrame({'File Location': [file_path], 
-                                         'Number of Objects': [last_value_in_A], 
-                                         'Sum of Integrated Density': [sum_values]}))
-
-    # Concatenate all DataFrames in the list
-    results = pd.concat(results, ignore_index=True)
-
-    # Write the results to a new Excel file
-    results.to_excel(savePath, index=False)
-    print("Done summary file generation")
+SUMMARY_HEADERS = ['File Location', 'Number of Objects', 'Sum of Integrated Density']
+
+def summarize_workbook(file_path):
+    """Read one per-image ROI workbook in a single streaming pass.
+
+    Returns (file_path, last value in the Label column, sum of the third column).
+    """
+    wb = load_workbook(file_path, read_only=True)
+    try:
+        ws = wb.active
+        sum_values = 0
+        last_value_in_A = None
+        for row in ws.iter_rows(min_row=2, values_only=True):
+            if not row:
+                continue
+            if row[0] is not None:
+                last_value_in_A = row[0]
+            if len(row) > 2 and row[2] is not None:
+                sum_values += row[2]
+    finally:
+        wb.close()
+
+    return file_path, last_value_in_A, sum_values
 
+def genmasterSheet(directory, savePath, records=None, workers=None):
+    """Write the summary sheet.
 
+    records is a list of (file location, number of objects, sum of integrated
+    density) rows, as returned by l2r.process_mask; when given, no workbook is
+    read. Otherwise every .xlsx/.xls file in directory is read with one
+    streaming pass, spread over `workers` processes.
+    """
+    with profiling.stage('summary', savePath):
+        if records is None:
+            # Scan all files in the directory
+            file_paths = [
+                os.path.join(directory, filename) for filename in os.listdir(directory)
+                if filename.endswith('.xlsx') or filename.endswith('.xls')
+            ]
+            workers = min(workers or os.cpu_count() or 1, len(file_paths))
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context()) as pool:
+                    records = list(pool.map(summarize_workbook, file_paths))
+            else:
+                records = [summarize_workbook(file_path) for file_path in file_paths]
+
+        results = pd.DataFrame(list(records), columns=SUMMARY_HEADERS)
+
+        # Write the results to a new Excel file
+        results.to_excel(savePath, index=False)
+    print("Done summary file generation")
@@ -0,0 +1,676 @@
+import multiprocessing
+import os
+import re
+import time
+import profiling
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# The stage functions below import l2r, segment and mastersheet when they run, so
+# importing this module (for the GUI or the command line) stays cheap.
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg')
+MASK_EXTENSIONS = ('.tif', '.tiff', '.png')  # In order of preference when a base name has several
+
+def worker_context():
+    """Start method for worker process pools.
+
+    Workers are spawned rather than forked: the GUI starts pools from a QThread
+    in a process that may already have initialised CUDA, and forked children
+    cannot use CUDA (and a forked multithreaded process can deadlock). Worker
+    entry points must therefore be module-level functions.
+    """
+    return multiprocessing.get_context("spawn")
+
+class ProgressMeter:
+    """Throttle a progress callback and add throughput and time remaining.
+
+    Called with the percentage of total items done, as the stages report it.
+    Calls callback(percent, rate, eta) at most every min_interval seconds, and
+    always for 100%, so a fast stage cannot flood a GUI event loop. rate is in
+    items per second and eta in seconds; both are None until an item has
+    finished. Items already done when the meter starts (completed) do not count
+    toward the rate.
+    """
+
+    def __init__(self, callback, total, completed=0, min_interval=0.25):
+        self.callback = callback
+        self.total = total
+        self.completed = completed
+        self.min_interval = min_interval
+        self.start_time = time.time()
+        self._last_report = None
+
+    def __call__(self, percent):
+        now = time.time()
+        if percent < 100 and self._last_report is not None and now - self._last_report < self.min_interval:
+            return
+        self._last_report = now
+
+        done = percent / 100 * self.total - self.completed
+        elapsed = now - self.start_time
+        rate = done / elapsed if done > 0 and elapsed > 0 else None
+        eta = self.total * (100 - percent) / 100 / rate if rate else None
+        self.callback(percent, rate, eta)
+
+def get_file_base_name(file_path):
+    """Get the base name of the file without extension."""
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+def index_original_images(base_dir):
+    """Walk base_dir once and map each image base name to the list of matching paths."""
+    index = {}
+    for root, dirs, files in os.walk(base_dir):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS) and "_cp_masks" not in file:
+                index.setdefault(get_file_base_name(file), []).append(os.path.join(root, file))
+    return index
+
+def pair_masks_with_originals(masks, index):
+    """Pair each mask with its original image by exact base name.
+
+    Returns (pairs, missing, ambiguous): pairs is a list of (mask, original) tuples,
+    missing lists masks with no original and ambiguous maps masks to their
+    candidate originals when more than one matches. When several candidates exist,
+    the one in the mask's own directory wins if it is unique.
+    """
+    pairs, missing, ambiguous = [], [], {}
+    for mask in masks:
+        candidates = index.get(re.sub(r'_cp_masks$', '', get_file_base_name(mask)), [])
+        if len(candidates) > 1:
+            same_dir = [c for c in candidates if os.path.dirname(c) == os.path.dirname(mask)]
+            candidates = same_dir if len(same_dir) == 1 else candidates
+
+        if not candidates:
+            missing.append(mask)
+        elif len(candidates) > 1:
+            ambiguous[mask] = candidates
+        else:
+            pairs.append((mask, candidates[0]))
+    return pairs, missing, ambiguous
+
+def find_masks(base_dir):
+    """List the Cellpose mask files (<base>_cp_masks.<ext>) in base_dir, one per base name.
+
+    When a base name has masks with several extensions (e.g. the .png of an
+    earlier whole-image run next to a tiled run's .tif), the first extension in
+    MASK_EXTENSIONS wins and the others are reported and skipped.
+    """
+    masks = {}
+    for f in sorted(os.listdir(base_dir)):
+        base_name, extension = os.path.splitext(f)
+        if base_name.endswith("_cp_masks") and extension.lower() in MASK_EXTENSIONS:
+            masks.setdefault(base_name, []).append(f)
+
+    found = []
+    for base_name, names in masks.items():
+        names.sort(key=lambda name: MASK_EXTENSIONS.index(os.path.splitext(name)[1].lower()))
+        for skipped in names[1:]:
+            print(f"Skipping mask file {skipped}: {names[0]} has the same base name")
+        found.append(os.path.join(base_dir, names[0]))
+    return found
+
+def find_images(base_dir):
+    """List the input images in base_dir, leaving out Cellpose masks."""
+    return [
+        entry.path for entry in os.scandir(base_dir)
+        if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS) and "_cp_masks" not in entry.name
+    ]
+
+def mask_path_for(image_path, tiled=False):
+    """Path of the mask written for image_path: Cellpose's PNG, or a TIFF in tiled mode.
+
+    The one place mask names are decided: the tiled segmenter writes to this
+    path, and the manifest and find_masks expect it.
+    """
+    return os.path.splitext(image_path)[0] + ("_cp_masks.tif" if tiled else "_cp_masks.png")
+
+def roi_output_paths(mask_path, output_dir):
+    """(Excel sheet, overlay PNG) written by Labels2ROIs for mask_path."""
+    base_name = get_file_base_name(mask_path)
+    return os.path.join(output_dir, f"{base_name}.xlsx"), os.path.join(output_dir, f"{base_name}_ROI.png")
+
+def segmentation_params(segmenter, diameter, tile_size=None, tile_overlap=128):
+    """Everything that changes the masks, as recorded in the manifest."""
+    from segment import CELLPROB_THRESHOLD, CHANNELS, FLOW_THRESHOLD
+
+    return {
+        'diameter': round(float(diameter), 2), 'model_type': segmenter.model_type, 'channels': CHANNELS,
+        'flow_threshold': FLOW_THRESHOLD, 'cellprob_threshold': CELLPROB_THRESHOLD,
+        'tile_size': tile_size, 'tile_overlap': tile_overlap if tile_size else None,
+    }
+
+def resolve_diameter(segmenter, base_dir, files, diameter, per_image_diameter=False, sample_size=None, tile_size=None, manifest=None):
+    """Diameter to segment with: diameter when set, otherwise one estimate for the whole plate.
+
+    With diameter 0, segment.StopFlag.estimate_diameter measures a sample of
+    files once and the whole run uses the median, instead of Cellpose running
+    its size model on every image. With a manifest the estimate is cached for
+    base_dir and reused while the sampled images are unchanged, so images added
+    later do not shift the diameter; an estimate cut short by segmenter.stop is
+    not cached. per_image_diameter keeps diameter 0, so
+    Cellpose estimates every image separately (slower). Falls back to 0 when
+    nothing could be measured.
+    """
+    from segment import CALIBRATION_SAMPLE_SIZE, CHANNELS, calibration_sample
+
+    if diameter or per_image_diameter or not files:
+        return diameter
+
+    sample_size = sample_size or CALIBRATION_SAMPLE_SIZE
+    params = {'model_type': segmenter.model_type, 'channels': CHANNELS, 'sample_size': sample_size, 'tile_size': tile_size}
+    if manifest is not None:
+        entry = manifest.entry('calibration', base_dir)
+        if entry and manifest.is_current('calibration', base_dir, list(entry['inputs']), params):
+            print(f"Using the cell diameter estimated in an earlier run: {entry['extra']['diameter']:.1f} px")
+            return entry['extra']['diameter']
+
+    estimate = segmenter.estimate_diameter(files, sample_size=sample_size, tile_size=tile_size)
+    if estimate is None:
+        print("Could not estimate the cell diameter; Cellpose will estimate it per image.")
+        return 0
+    if manifest is not None and not segmenter.stop:  # A cancelled calibration measured only part of the sample
+        manifest.record('calibration', base_dir, calibration_sample(files, sample_size), params, [], extra={'diameter': estimate})
+        manifest.save()
+    return estimate
+
+def run_segmentation(base_dir, diameter, batch_size=1, model_type='cyto', gpu=None, segmenter=None, progress_callback=None,
+                     manifest=None, tile_size=None, tile_overlap=128, per_image_diameter=False, calibration_sample_size=None):
+    """Segment every image in base_dir. Returns a list of (filename, error message) for failures.
+
+    segmenter is an existing segment.StopFlag (so a caller can stop it); one is
+    created when not given. progress_callback(percent, rate, eta) is throttled
+    (see ProgressMeter). With a manifest.RunManifest, images whose mask is up
+    to date for the same parameters are skipped and new masks are recorded. With
+    tile_size set, images are segmented in overlapping tiles into *_cp_masks.tif.
+    A diameter of 0 is estimated once for the run (see resolve_diameter).
+    """
+    from segment import StopFlag
+
+    if segmenter is None:
+        segmenter = StopFlag(model_type=model_type, gpu=gpu)
+
+    print(f"Running segmentation in directory: {base_dir}")
+    files = find_images(base_dir)
+    diameter = resolve_diameter(segmenter, base_dir, files, diameter, per_image_diameter, calibration_sample_size, tile_size, manifest)
+    params = segmentation_params(segmenter, diameter, tile_size, tile_overlap)
+
+    def record_mask(filename):
+        manifest.record('segment', filename, [filename], params, [mask_path_for(filename, tiled=bool(tile_size))])
+
+    on_saved = None
+    if manifest is not None:
+        pending = [f for f in files if not manifest.is_current('segment', f, [f], params)]
+        if len(pending) < len(files):
+            print(f"Skipping {len(files) - len(pending)} image(s) already segmented with the same parameters.")
+        files = pending
+        on_saved = record_mask
+
+    if progress_callback:
+        progress_callback = ProgressMeter(progress_callback, len(files))
+
+    try:
+        return segmenter.segment(
+            base_dir, diameter=diameter, progress_callback=progress_callback, batch_size=batch_size,
+            files=files, on_saved=on_saved, tile_size=tile_size, tile_overlap=tile_overlap
+        )
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+def run_labels2rois(base_dir, output_dir, workers=1, render_plots=False, save_excel=True, dataset_format=None, use_gpu=True,
+                    progress_callback=None, manifest=None, tile_size=None, stop_flag=None):
+    """Run Labels2ROIs for every mask in base_dir, writing results to output_dir.
+
+    Returns (records, failed): the summary sheet rows and the masks that could not
+    be processed, including masks with a missing or ambiguous original image.
+
+    With a manifest.RunManifest, masks whose outputs are up to date for the same
+    mask, original and options are skipped and their summary rows are taken from
+    the manifest. A run-wide dataset needs every image's table, so when one is
+    requested either everything is up to date or every mask is processed.
+
+    With tile_size set, statistics are accumulated tile by tile and no overlays
+    are written (see l2r.process_mask).
+
+    progress_callback(percent, rate, eta) is throttled (see ProgressMeter). When
+    stop_flag.stop is set (stop_flag is e.g. a segment.StopFlag), masks not yet
+    started are left unprocessed.
+    """
+    masks = find_masks(base_dir)
+    total_masks = len(masks)
+    print(f"Found {total_masks} masks for processing.")
+
+    if total_masks == 0:
+        if progress_callback:
+            progress_callback(100)  # If no masks, set progress to 100%
+        return [], []
+
+    if progress_callback:
+        progress_callback(0)  # Initialize Labels2ROIs progress to 0
+
+    # Pair every mask with its original up front, so problems are reported before any work starts
+    pairs, missing, ambiguous = pair_masks_with_originals(masks, index_original_images(base_dir))
+    for mask in missing:
+        print(f"Warning: Original image not found for mask file: {mask}")
+    for mask, candidates in ambiguous.items():
+        print(f"Warning: Several original images match mask file {mask}, skipping it: {', '.join(candidates)}")
+
+    tasks = []
+    for label_image_path, original_image_path in pairs:
+        excel_output_path, plot_output_path = roi_output_paths(label_image_path, output_dir)
+        print(f"Mask file: {label_image_path} -> original image: {original_image_path}")
+        tasks.append((label_image_path, original_image_path, excel_output_path, plot_output_path))
+
+    options = dict(show_labels=True, render_plot=render_plots, save_excel=save_excel, use_gpu=use_gpu, tile_size=tile_size)
+    params = dict(options, use_gpu=None)  # The device does not change the results
+    dataset_path = None
+    if dataset_format:
+        from roiwriters import DATASET_FORMATS
+        dataset_path = os.path.join(output_dir, f"ROIs{DATASET_FORMATS[dataset_format]}")
+
+    records_by_mask = {}
+    pending = tasks
+    if manifest is not None:
+        pending = [task for task in tasks if not manifest.is_current('rois', task[0], task[:2], params)]
+        dataset_inputs = [path for task in tasks for path in task[:2]]
+        if dataset_path and pending == [] and not manifest.is_current('dataset', dataset_path, dataset_inputs, params):
+            pending = tasks
+        elif dataset_path and pending:
+            pending = tasks  # The dataset is rewritten as a whole
+        if len(pending) < len(tasks):
+            print(f"Skipping {len(tasks) - len(pending)} mask(s) with up-to-date ROI outputs.")
+        pending_masks = {task[0] for task in pending}
+        for task in tasks:
+            if task[0] not in pending_masks:
+                records_by_mask[task[0]] = tuple(manifest.entry('rois', task[0])['extra'])
+
+    def mask_succeeded(task, record):
+        records_by_mask[task[0]] = record
+        if manifest is not None:
+            outputs = ([] if tile_size else [task[3]]) + ([task[2]] if save_excel else [])
+            manifest.record('rois', task[0], task[:2], params, outputs, extra=record)
+
+    dataset = None
+    if dataset_path and pending:
+        from roiwriters import ROIDatasetWriter
+        dataset = ROIDatasetWriter(dataset_path)
+
+    if progress_callback:
+        progress_callback = ProgressMeter(progress_callback, total_masks, completed=total_masks - len(pending))
+
+    # Bound before the try: the finally block reads them even if process_masks raises
+    failed = []
+    finished = False
+    try:
+        _, failed = process_masks(
+            pending, total_masks, workers=workers, options=options, dataset=dataset,
+            completed=total_masks - len(pending), progress_callback=progress_callback, on_success=mask_succeeded,
+            stop_flag=stop_flag
+        )
+        finished = True
+    finally:
+        if dataset is not None:
+            dataset.close()
+        if manifest is not None:
+            for mask in failed:
+                manifest.forget('rois', mask)
+            if dataset is not None and finished and not failed and not (stop_flag and stop_flag.stop):
+                manifest.record('dataset', dataset_path, dataset_inputs, params, [dataset.path])
+            manifest.save()
+
+    records = [records_by_mask[task[0]] for task in tasks if task[0] in records_by_mask]
+    failed = missing + list(ambiguous) + failed
+    if failed:
+        print(f"{len(failed)} mask(s) failed during Labels2ROIs: {', '.join(failed)}")
+    return records, failed
+
+def process_masks(tasks, total_masks, workers=1, options=None, dataset=None, completed=0, progress_callback=None, on_success=None,
+                  stop_flag=None):
+    """Run l2r.process_mask for every task, in a process pool when workers > 1.
+
+    A mask that raises is reported and skipped. When dataset is an
+    roiwriters.ROIDatasetWriter, each image's ROI table is appended to it as it
+    completes. on_success(task, record) is called for every mask that succeeds. Returns (records, failed): the summary sheet rows in task order
+    and the failed mask paths. Once stop_flag.stop is set, no further mask is
+    started; masks already running in the pool still finish.
+    """
+    import l2r
+
+    records = {}
+    failed = []
+    options = dict(options or {}, return_stats=dataset is not None)
+
+    def mask_done(task, error, result=None):
+        nonlocal completed
+        label_image_path, original_image_path = task[0], task[1]
+        if error is not None:
+            print(f"Error processing mask file {label_image_path}: {error}")
+            failed.append(label_image_path)
+        elif dataset is not None:
+            records[label_image_path], stats = result
+            with profiling.stage('dataset_append', original_image_path):
+                dataset.append(os.path.basename(original_image_path), stats)
+        else:
+            records[label_image_path] = result
+        if error is None and on_success:
+            on_success(task, records[label_image_path])
+        completed += 1
+        if progress_callback:
+            progress_callback((completed / total_masks) * 100)
+
+    if workers > 1 and len(tasks) > 1:
+        profiler = profiling.get_profiler()
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=worker_context()) as pool:
+            futures = {pool.submit(process_mask_traced, task, options, profiler is not None): task for task in tasks}
+            for future in as_completed(futures):
+                if stop_flag is not None and stop_flag.stop:
+                    for pending_future in futures:
+                        pending_future.cancel()
+                if future.cancelled():
+                    continue
+                try:
+                    result, trace = future.result()
+                except Exception as e:
+                    mask_done(futures[future], e)
+                else:
+                    if profiler is not None:
+                        profiler.extend(trace)
+                    mask_done(futures[future], None, result)
+    else:
+        for task in tasks:
+            if stop_flag is not None and stop_flag.stop:
+                break
+            try:
+                result = l2r.process_mask(*task, **options)
+            except Exception as e:
+                mask_done(task, e)
+            else:
+                mask_done(task, None, result)
+
+    return [records[task[0]] for task in tasks if task[0] in records], failed
+
+def process_mask_traced(task, options, trace=True):
+    """Process-pool entry point: run l2r.process_mask and return (result, profiling records).
+
+    Worker processes have no profiler of their own, so with trace set one is
+    activated for the call and its records are sent back to be merged.
+    """
+    import l2r
+
+    if not trace:
+        return l2r.process_mask(*task, **options), []
+    with profiling.activate(profiling.Profiler()) as profiler:
+        result = l2r.process_mask(*task, **options)
+    return result, profiler.records
+
+def run_segmentation_with_rois(base_dir, output_dir, diameter, batch_size=1, model_type='cyto', gpu=None, segmenter=None,
+                               workers=1, render_plots=False, save_excel=True, dataset_format=None, use_gpu=True, keep_masks=False,
+                               manifest=None, segmentation_progress=None, rois_progress=None, per_image_diameter=False,
+                               calibration_sample_size=None):
+    """Segment every image in base_dir and hand each mask straight to Labels2ROIs in memory.
+
+    Used when both stages run: the label array and the image already loaded for
+    the model go to l2r.process_mask directly, so masks are not encoded, written,
+    found again by name and decoded. Mask files are only written with
+    keep_masks. Outputs have the same names as with run_segmentation followed by
+    run_labels2rois. A diameter of 0 is estimated once (see resolve_diameter).
+
+    segmentation_progress and rois_progress are called as (percent, rate, eta)
+    and throttled (see ProgressMeter). Setting segmenter.stop stops after the
+    images already handed over.
+
+    Returns (errors, records, failed): segmentation errors as (filename,
+    message), the summary sheet rows and the images whose ROI stage failed.
+    With a manifest, images whose ROI outputs are up to date for the same image
+    and parameters are skipped; as in run_labels2rois, a requested dataset is
+    rewritten from every image when any image changed.
+    """
+    from segment import StopFlag
+
+    if segmenter is None:
+        segmenter = StopFlag(model_type=model_type, gpu=gpu)
+
+    print(f"Running segmentation and Labels2ROIs in directory: {base_dir}")
+    files = find_images(base_dir)
+    diameter = resolve_diameter(segmenter, base_dir, files, diameter, per_image_diameter, calibration_sample_size, manifest=manifest)
+    options = dict(show_labels=True, render_plot=render_plots, save_excel=save_excel, use_gpu=use_gpu)
+    params = dict(segmentation_params(segmenter, diameter), rois=dict(options, use_gpu=None), keep_masks=keep_masks)
+    dataset_path = None
+    if dataset_format:
+        from roiwriters import DATASET_FORMATS
+        dataset_path = os.path.join(output_dir, f"ROIs{DATASET_FORMATS[dataset_format]}")
+
+    records_by_image = {}
+    pending = files
+    if manifest is not None:
+        pending = [f for f in files if not manifest.is_current('segment_rois', f, [f], params)]
+        if dataset_path and (pending or not manifest.is_current('dataset', dataset_path, files, params)):
+            pending = files  # The dataset is rewritten as a whole
+        if len(pending) < len(files):
+            print(f"Skipping {len(files) - len(pending)} image(s) with up-to-date ROI outputs.")
+        for f in files:
+            if f not in pending:
+                records_by_image[f] = tuple(manifest.entry('segment_rois', f)['extra'])
+
+    def image_succeeded(image_path, record):
+        records_by_image[image_path] = record
+        if manifest is not None:
+            excel_output_path, plot_output_path = roi_output_paths(mask_path_for(image_path), output_dir)
+            outputs = [plot_output_path] + ([excel_output_path] if save_excel else []) + ([mask_path_for(image_path)] if keep_masks else [])
+            manifest.record('segment_rois', image_path, [image_path], params, outputs, extra=record)
+
+    def record_mask(filename):
+        manifest.record('segment', filename, [filename], segmentation_params(segmenter, diameter), [mask_path_for(filename)])
+
+    on_saved = record_mask if keep_masks and manifest is not None else None
+
+    dataset = None
+    if dataset_path and pending:
+        from roiwriters import ROIDatasetWriter
+        dataset = ROIDatasetWriter(dataset_path)
+
+    if segmentation_progress:
+        segmentation_progress = ProgressMeter(segmentation_progress, len(pending))
+    if rois_progress:
+        rois_progress = ProgressMeter(rois_progress, len(files), completed=len(files) - len(pending))
+
+    handoff = RoiHandoff(
+        output_dir, workers=workers, options=options, dataset=dataset, total=len(files),
+        completed=len(files) - len(pending), progress_callback=rois_progress, on_success=image_succeeded,
+        stop_flag=segmenter
+    )
+    errors, failed = [], []
+    finished = False
+    try:
+        errors = segmenter.segment(
+            base_dir, diameter=diameter, progress_callback=segmentation_progress, batch_size=batch_size,
+            files=pending, on_saved=on_saved, save_masks=keep_masks, on_segmented=handoff.submit
+        )
+        finished = True
+    finally:
+        failed = handoff.close()
+        if dataset is not None:
+            dataset.close()
+        if manifest is not None:
+            if dataset is not None and finished and not failed and not segmenter.stop:
+                manifest.record('dataset', dataset_path, files, params, [dataset.path])
+            manifest.save()
+
+    if rois_progress and not segmenter.stop:
+        rois_progress(100)
+    records = [records_by_image[f] for f in files if f in records_by_image]
+    if failed:
+        print(f"{len(failed)} image(s) failed during Labels2ROIs: {', '.join(failed)}")
+    return errors, records, failed
+
+class RoiHandoff:
+    """Run Labels2ROIs on images handed over in memory by StopFlag.segment.
+
+    submit(image_path, image, masks) is the segmenter's on_segmented callback.
+    With workers > 1 the image and label array are sent to a pool of that many
+    worker processes, as run_labels2rois does with mask files; with one worker
+    the work runs on a single thread, still overlapping with the model. At most
+    `workers` images wait or run at a time, so finished masks cannot pile up in
+    memory while the model runs ahead. Results are collected in submission order
+    on the submitting thread, where the dataset is appended to and
+    on_success(image_path, record) is called. An image whose work cannot be
+    submitted or raises (including a worker process dying) is reported and
+    counted as failed, as in process_masks. Once stop_flag.stop is set, new
+    images are refused and those not yet started are cancelled.
+    """
+
+    def __init__(self, output_dir, workers=1, options=None, dataset=None, total=0, completed=0, progress_callback=None, on_success=None,
+                 stop_flag=None):
+        self.output_dir = output_dir
+        self.workers = max(1, workers)
+        self.options = options or {}
+        self.dataset = dataset
+        self.total = total
+        self.completed = completed
+        self.progress_callback = progress_callback
+        self.on_success = on_success
+        self.stop_flag = stop_flag
+        self.failed = []
+        self.pending = deque()  # (image_path, future)
+        if self.workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=worker_context())
+            self.trace = profiling.get_profiler() is not None
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='labels2rois')
+            self.trace = False  # The thread records into the active profiler itself
+
+    @property
+    def stopped(self):
+        return self.stop_flag is not None and self.stop_flag.stop
+
+    def submit(self, image_path, image, masks):
+        if self.stopped:
+            self._cancel_pending()
+            return
+        while self.pending and (self.pending[0][1].done() or len(self.pending) >= self.workers):
+            self._finish(*self.pending.popleft())
+        try:
+            future = self.pool.submit(rois_from_arrays_traced, image_path, image, masks, self.output_dir, self.options, self.trace)
+        except Exception as e:  # e.g. BrokenProcessPool after a worker died
+            self._failed(image_path, e)
+        else:
+            self.pending.append((image_path, future))
+
+    def close(self):
+        """Wait for the outstanding images and return the paths of those that failed."""
+        if self.stopped:
+            self._cancel_pending()
+        while self.pending:
+            self._finish(*self.pending.popleft())
+        self.pool.shutdown(wait=True)
+        return self.failed
+
+    def _cancel_pending(self):
+        for _, future in self.pending:
+            future.cancel()  # Only succeeds for images not yet started
+
+    def _finish(self, image_path, future):
+        if future.cancelled():
+            return
+        try:
+            (record, stats), trace = future.result()
+        except Exception as e:
+            self._failed(image_path, e)
+            return
+        profiler = profiling.get_profiler()
+        if profiler is not None:
+            profiler.extend(trace)
+        if self.dataset is not None:
+            with profiling.stage('dataset_append', image_path):
+                self.dataset.append(os.path.basename(image_path), stats)
+        if self.on_success:
+            self.on_success(image_path, record)
+        self._advance()
+
+    def _failed(self, image_path, error):
+        print(f"Error processing masks of {image_path}: {error}")
+        self.failed.append(image_path)
+        self._advance()
+
+    def _advance(self):
+        self.completed += 1
+        if self.progress_callback and self.total:
+            self.progress_callback((self.completed / self.total) * 100)
+
+def rois_from_arrays(image_path, image, masks, output_dir, options):
+    """l2r.process_mask for a label array and an image already in memory; returns (record, stats).
+
+    The image is converted in memory when that matches what reading the file
+    gives (see imagecache.color_and_gray), otherwise the file is read again.
+    """
+    import l2r
+    from imagecache import color_and_gray
+
+    mask_path = mask_path_for(image_path)
+    excel_output_path, plot_output_path = roi_output_paths(mask_path, output_dir)
+    return l2r.process_mask(
+        mask_path, image_path, excel_output_path, plot_output_path, label_image=masks,
+        original_image=color_and_gray(image), **dict(options, return_stats=True)
+    )
+
+def rois_from_arrays_traced(image_path, image, masks, output_dir, options, trace=True):
+    """Pool entry point for rois_from_arrays; returns (result, profiling records) like process_mask_traced."""
+    if not trace:
+        return rois_from_arrays(image_path, image, masks, output_dir, options), []
+    with profiling.activate(profiling.Profiler()) as profiler:
+        result = rois_from_arrays(image_path, image, masks, output_dir, options)
+    return result, profiler.records
+
+def run_excel_export(output_dir, dataset_format, records=None):
+    """Write the per-image Excel sheets from the run's ROI dataset in output_dir.
+
+    The optional last step of a run without per-image Excel output. records are
+    the rows returned by run_labels2rois; they are returned with each exported
+    image's file location pointing at its new sheet, as if the sheets had been
+    written during the run.
+    """
+    from roiwriters import DATASET_FORMATS, export_dataset_to_excel
+
+    dataset_path = os.path.join(output_dir, f"ROIs{DATASET_FORMATS[dataset_format]}")
+    if not os.path.exists(dataset_path):
+        dataset_path = os.path.splitext(dataset_path)[0] + DATASET_FORMATS['npz']  # Parquet falls back to .npz
+    if not os.path.exists(dataset_path):
+        print(f"No ROI dataset in {output_dir} to export to Excel.")
+        return records
+
+    with profiling.stage('excel_export', dataset_path):
+        written = set(export_dataset_to_excel(dataset_path, output_dir))
+    print(f"Exported {len(written)} Excel sheet(s) from {dataset_path}")
+    if records is None:
+        return None
+
+    exported = []
+    for record in records:
+        excel_output_path, _ = roi_output_paths(mask_path_for(record[0]), output_dir)
+        exported.append((excel_output_path, *record[1:]) if excel_output_path in written else tuple(record))
+    return exported
+
+def run_summary(output_dir, records=None, manifest=None):
+    """Write SummarySheet/Summary.xlsx in output_dir and return its path.
+
+    records are the rows returned by run_labels2rois; without them the per-image
+    workbooks already in output_dir are read instead. With a manifest, the sheet
+    is not rewritten when it already holds exactly these records.
+    """
+    from mastersheet import genmasterSheet
+
+    summary_dir = os.path.join(output_dir, "SummarySheet")
+    os.makedirs(summary_dir, exist_ok=True)
+    master_excel_save_path = os.path.join(summary_dir, "Summary.xlsx")
+
+    params = {'records': records}
+    if manifest is not None and records is not None and manifest.is_current('summary', master_excel_save_path, [], params):
+        print("Summary sheet is up to date.")
+        return master_excel_save_path
+
+    genmasterSheet(directory=output_dir, savePath=master_excel_save_path, records=records)
+    if manifest is not None and records is not None:
+        manifest.record('summary', master_excel_save_path, [], params, [master_excel_save_path])
+        manifest.save()
+    return master_excel_save_path
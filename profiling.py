@@ -0,0 +1,161 @@
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TRACE_NAME = "s2l_profile"
+TRACE_FIELDS = ['stage', 'image', 'start', 'seconds', 'peak_rss_mb', 'gpu_mb', 'rois', 'pid']
+
+# The profiler that stage() records into; None means profiling is off
+_active = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MiB (None if unknown)."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB elsewhere
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2**20
+    except Exception:
+        return None
+
+
+def gpu_memory_mb():
+    """Peak GPU memory allocated by torch (or held by CuPy's pool), in MiB, if either is in use."""
+    try:
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated() / 2**20
+        cupy = sys.modules.get('cupy')
+        if cupy is not None:
+            return cupy.get_default_memory_pool().total_bytes() / 2**20
+    except Exception:
+        pass
+    return None
+
+
+class Profiler:
+    """Per-image, per-stage timing and resource trace of a pipeline run.
+
+    Each record holds the stage name, the image it belongs to, its wall time, the
+    process's peak RSS and GPU memory at the end of the stage, and the ROI count
+    where it applies. Records from worker processes are merged with extend().
+    """
+
+    def __init__(self):
+        self.records = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def extend(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self):
+        """Totals per stage: count, total/mean/max seconds, peak RSS and GPU memory, ROI count."""
+        stages = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            stats = stages.setdefault(record['stage'], {
+                'count': 0, 'total_s': 0.0, 'max_s': 0.0, 'peak_rss_mb': None, 'gpu_mb': None, 'rois': 0
+            })
+            stats['count'] += 1
+            stats['total_s'] += record['seconds']
+            stats['max_s'] = max(stats['max_s'], record['seconds'])
+            stats['rois'] += record.get('rois') or 0
+            for key in ('peak_rss_mb', 'gpu_mb'):
+                if record.get(key) is not None:
+                    stats[key] = max(stats[key] or 0.0, record[key])
+        for stats in stages.values():
+            stats['mean_s'] = stats['total_s'] / stats['count']
+        return stages
+
+    def summary_text(self):
+        """Short human-readable table of summary(), slowest stage first."""
+        lines = [f"Run time: {time.time() - self.started:.1f} s"]
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]['total_s']):
+            line = f"{name}: {stats['total_s']:.2f} s total, {stats['mean_s']:.3f} s mean over {stats['count']}"
+            if stats['peak_rss_mb'] is not None:
+                line += f", peak RSS {stats['peak_rss_mb']:.0f} MiB"
+            if stats['gpu_mb'] is not None:
+                line += f", GPU {stats['gpu_mb']:.0f} MiB"
+            if stats['rois']:
+                line += f", {stats['rois']} ROIs"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def write(self, output_dir, name=TRACE_NAME):
+        """Write the trace as <name>.json (records and summary) and <name>.csv (records)."""
+        with self._lock:
+            records = list(self.records)
+        json_path = os.path.join(output_dir, f"{name}.json")
+        csv_path = os.path.join(output_dir, f"{name}.csv")
+
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({'started': self.started, 'summary': self.summary(), 'records': records}, f, indent=1)
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=TRACE_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+        return json_path, csv_path
+
+
+def get_profiler():
+    """Return the active Profiler, or None when profiling is off."""
+    return _active
+
+
+@contextmanager
+def activate(profiler):
+    """Make profiler the one stage() records into for the duration of the block."""
+    global _active
+    previous, _active = _active, profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+
+
+@contextmanager
+def stage(name, image=None):
+    """Time a pipeline stage on the active profiler.
+
+    Yields a dict; set 'rois' in it to record an ROI count. Does nothing but
+    yield when no profiler is active.
+    """
+    profiler = _active
+    extra = {}
+    if profiler is None:
+        yield extra
+        return
+
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield extra
+    finally:
+        profiler.add({
+            'stage': name,
+            'image': image,
+            'start': start,
+            'seconds': time.perf_counter() - start_counter,
+            'peak_rss_mb': peak_rss_mb(),
+            'gpu_mb': gpu_memory_mb(),
+            'rois': extra.get('rois'),
+            'pid': os.getpid(),
+        })
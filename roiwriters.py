@@ -0,0 +1,144 @@
+import os
+import importlib.util
+import numpy as np
+import xlsxwriter
+
+# pyarrow is only imported when a Parquet dataset is actually read or written
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+ROI_HEADERS = [
+    'Label', 'Area', 'Integrated Density', 'Mean Gray Value', 'Standard Deviation',
+    'Centroid X', 'Centroid Y', 'BBox X', 'BBox Y', 'BBox Width', 'BBox Height'
+]
+
+# Dataset formats offered for the whole-run ROI table, mapped to their file extension
+DATASET_FORMATS = {'parquet': '.parquet', 'npz': '.npz'}
+
+
+def write_rois_excel(stats, excel_output_path):
+    """Write one image's ROI statistics to an .xlsx sheet, one row per label."""
+    roi_data = zip(*(stats[header].tolist() for header in ROI_HEADERS))
+
+    # Save to Excel using xlsxwriter
+    with xlsxwriter.Workbook(excel_output_path) as workbook:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, ROI_HEADERS)
+
+        for row, data in enumerate(roi_data, start=1):
+            worksheet.write_row(row, 0, data)
+
+
+class ROIDatasetWriter:
+    """Collect the ROI tables of a whole run into a single columnar dataset.
+
+    Every appended image contributes its rows plus an 'Image' column naming it.
+    Parquet output is written in row groups of about rows_per_flush rows, so it
+    is appended to as the run goes; .npz output is written in one go on close.
+    Parquet needs pyarrow; without it the dataset falls back to .npz.
+    """
+
+    def __init__(self, path, rows_per_flush=250000):
+        root, ext = os.path.splitext(path)
+        if ext == '.parquet' and not PYARROW_AVAILABLE:
+            print("pyarrow is not installed, writing the ROI dataset as .npz instead of Parquet.")
+            ext = '.npz'
+        if ext not in DATASET_FORMATS.values():
+            raise ValueError(f"Unsupported ROI dataset format: {ext}")
+
+        self.path = root + ext
+        self.format = ext[1:]
+        self.rows_per_flush = rows_per_flush
+        self._chunks = []
+        self._buffered_rows = 0
+        self._parquet_writer = None
+
+    def append(self, image, stats):
+        """Add the ROI statistics of one image."""
+        rows = len(stats['Label'])
+        if rows == 0:
+            return
+        chunk = {'Image': np.full(rows, image)}
+        chunk.update((header, np.asarray(stats[header])) for header in ROI_HEADERS)
+        self._chunks.append(chunk)
+        self._buffered_rows += rows
+
+        if self.format == 'parquet' and self._buffered_rows >= self.rows_per_flush:
+            self._flush_parquet()
+
+    def close(self):
+        """Write any buffered rows and finish the dataset file."""
+        if self.format == 'parquet':
+            self._flush_parquet()
+            if self._parquet_writer is None:
+                import pyarrow.parquet as pq
+                self._parquet_writer = pq.ParquetWriter(self.path, self._schema())
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        else:
+            np.savez_compressed(self.path, **self._concatenate())
+            self._chunks = []
+        print(f"ROI dataset saved to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _concatenate(self):
+        columns = ['Image'] + ROI_HEADERS
+        if not self._chunks:
+            return {'Image': np.array([], dtype=str), **{header: np.array([]) for header in ROI_HEADERS}}
+        return {column: np.concatenate([chunk[column] for chunk in self._chunks]) for column in columns}
+
+    def _schema(self):
+        import pyarrow as pa
+
+        fields = [pa.field('Image', pa.string())]
+        fields += [pa.field(header, pa.float64()) for header in ROI_HEADERS]
+        return pa.schema(fields)
+
+    def _flush_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._chunks:
+            return
+        table = pa.table(self._concatenate())
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = table.cast(self._parquet_writer.schema)
+        self._parquet_writer.write_table(table)
+        self._chunks = []
+        self._buffered_rows = 0
+
+
+def load_roi_dataset(path):
+    """Load a dataset written by ROIDatasetWriter as a dict of column arrays."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        return {column: table.column(column).to_numpy() for column in table.column_names}
+    with np.load(path) as data:
+        return {column: data[column] for column in data.files}
+
+
+def export_dataset_to_excel(path, output_dir):
+    """Write one per-image .xlsx sheet from a ROI dataset, as the per-image pipeline does.
+
+    Sheets get the pipeline's names (<image base>_cp_masks.xlsx, see
+    pipeline.roi_output_paths), so they replace the sheets a run with Excel
+    output would have written. Returns the written file paths.
+    """
+    from pipeline import mask_path_for, roi_output_paths
+
+    data = load_roi_dataset(path)
+    images = data['Image']
+    written = []
+    for image in dict.fromkeys(images.tolist()):
+        rows = images == image
+        excel_output_path, _ = roi_output_paths(mask_path_for(image), output_dir)
+        write_rois_excel({header: data[header][rows] for header in ROI_HEADERS}, excel_output_path)
+        written.append(excel_output_path)
+    return written
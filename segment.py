@@ -1,65 +1,382 @@
-import torch
 import numpy as np
 import time
 import threading
 import os
-from cellpose import io, models, transforms
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from cellpose import io, transforms
 import tqdm
+import profiling
+import tiling
+from pipeline import mask_path_for
+
+FLOW_THRESHOLD = 0.3
+CELLPROB_THRESHOLD = 0
+CHANNELS = [0, 0]
+CALIBRATION_SAMPLE_SIZE = 8  # Images used to estimate the diameter once per run
+
+# Shared Cellpose models keyed by (model_type, gpu), so each model is loaded once per process
+_models = {}
+_models_lock = threading.Lock()
+_model_load_stats = {}
+
+
+def get_model(model_type='cyto', gpu=None):
+    """Return the shared Cellpose model for (model_type, gpu), loading it on first use.
+
+    torch and the Cellpose models are imported here, so code that only drives
+    StopFlag with a model of its own (such as benchmark.py) does not need them.
+    """
+    import torch
+    from cellpose import models
+
+    if gpu is None:
+        gpu = torch.cuda.is_available()
+    key = (model_type, bool(gpu))
+
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            start_time = time.time()
+            model = models.Cellpose(gpu=key[1], model_type=model_type)
+            load_time = time.time() - start_time
+            _models[key] = model
+
+            stats = _model_load_stats.setdefault(key, {'loads': 0, 'seconds': 0.0})
+            stats['loads'] += 1
+            stats['seconds'] += load_time
+            print(f"Loaded Cellpose model '{model_type}' (gpu={key[1]}) in {load_time:.2f} seconds")
+    return model
+
+
+def model_load_stats():
+    """Return how many times each model has been loaded and the total load time in seconds."""
+    with _models_lock:
+        return {key: dict(stats) for key, stats in _model_load_stats.items()}
+
 
 class StopFlag:
-    def __init__(self):
+    def __init__(self, model_type='cyto', gpu=None):
         self.stop = False
-        self.model = models.Cellpose(gpu=torch.cuda.is_available(), model_type='cyto')  # Initialize Cellpose model
+        self.model_type = model_type
+        self.gpu = gpu
+
+    @property
+    def model(self):
+        """Shared Cellpose model, created on first access."""
+        return get_model(self.model_type, self.gpu)
+
+    def segment(self, directory, diameter, progress_callback=None, batch_size=1, tile_batch_size=8,
+                read_workers=2, prefetch=4, write_workers=2, save_timeout=30.0, files=None, on_saved=None,
+                tile_size=None, tile_overlap=128, save_masks=True, on_segmented=None):
+        """Segment every file in directory and save a mask next to each image.
+
+        Reading and smoothing run ahead of the model on a reader pool (at most
+        prefetch images in flight) and mask saves drain in the background through
+        a MaskWriter, so inference does not wait on disk. Images of the same shape
+        are grouped into batches of up to batch_size and passed to a single
+        model.eval call. tile_batch_size is forwarded to Cellpose as its own
+        batch_size (number of network tiles per forward pass).
 
-    def segment(self, directory, diameter, progress_callback=None):
+        files restricts the run to the given paths instead of every file in
+        directory. on_saved(filename) is called once the masks of filename have
+        been written.
+
+        on_segmented(filename, img, masks) is called with every image and its
+        label array as soon as the model returns, so a later stage can use them
+        without reading the mask file back. With save_masks off, no mask files
+        are written at all.
+
+        With tile_size set, each image is instead segmented in overlapping tiles
+        (see segment_files_tiled), for images too large to process whole.
+
+        Returns a list of (filename, error message) for images that failed.
+        """
         start_time = time.time()
 
-        files = [filename.path for filename in os.scandir(directory) if filename.is_file()]
+        if files is None:
+            files = [filename.path for filename in os.scandir(directory) if filename.is_file()]
         total_files = len(files)
 
         if total_files == 0:
             if progress_callback:
                 progress_callback(100)  # If no files, set progress to 100%
             print("No files to process.")
-            return
+            return []
+
+        if tile_size:
+            errors = self.segment_files_tiled(files, diameter, tile_size, tile_overlap, progress_callback, on_saved)
+            print(f"Tiled segmentation completed in {time.time() - start_time:.2f} seconds")
+            return errors
+
+        chan = CHANNELS
+        batch_size = max(1, int(batch_size))
+        pending = {}  # image shape -> list of (filename, img, img_smoothed)
+        errors = []
+        done = 0
+        writer = MaskWriter(workers=write_workers, timeout=save_timeout, on_saved=on_saved)
+
+        def run_batch(batch):
+            nonlocal done
+            try:
+                results = self.eval_batch(batch, diameter, chan, tile_batch_size)
+            except Exception as e:
+                print(f"Error segmenting batch of {len(batch)} image(s): {e}")
+                errors.extend((filename, str(e)) for filename, _, _ in batch)
+                results = [None] * len(batch)
+
+            # Progress is reported per image, not per batch
+            for (filename, img, _), result in zip(batch, results):
+                if result is not None:
+                    masks, flows = result
+                    if save_masks:
+                        writer.submit(img, masks, flows, filename)
+                    if on_segmented:
+                        on_segmented(filename, img, masks)
+                done += 1
+                pbar.update(1)
+                if progress_callback:
+                    progress_callback((done / total_files) * 100)
+
+        try:
+            with tqdm.tqdm(total=total_files) as pbar:
+                for filename, img, img_smoothed, error in prefetch_images(files, workers=read_workers, prefetch=prefetch):
+                    if self.stop:
+                        break
+                    if error is not None:
+                        print(f"Error reading {filename}: {error}")
+                        errors.append((filename, error))
+                        done += 1
+                        pbar.update(1)
+                        continue
+
+                    batch = pending.setdefault(img.shape, [])
+                    batch.append((filename, img, img_smoothed))
+                    if len(batch) >= batch_size:
+                        del pending[img.shape]
+                        run_batch(batch)
+
+                # Flush the partially filled batches
+                for batch in pending.values():
+                    if self.stop:
+                        break
+                    run_batch(batch)
+        finally:
+            # Saves already queued still finish and reach on_saved, even if a callback raised
+            errors.extend(writer.close())
+
+        if self.stop:
+            print(f"Segmentation stopped after {done} of {total_files} image(s)")
+        elif progress_callback:
+            progress_callback(100)  # Ensure progress is set to 100% after completion
+
+        print(f"Segmentation completed in {time.time() - start_time:.2f} seconds")
+        if errors:
+            print(f"{len(errors)} image(s) failed during segmentation.")
+        for (model_type, gpu), stats in model_load_stats().items():
+            print(f"Cellpose model '{model_type}' (gpu={gpu}) loaded {stats['loads']} time(s), {stats['seconds']:.2f} seconds total")
+        return errors
 
-        stop_flag = StopFlag()
-        channels = [[0, 0]]
+    def segment_files_tiled(self, files, diameter, tile_size, overlap=128, progress_callback=None, on_saved=None):
+        """Segment large images tile by tile, stitching labels across tile borders.
+
+        Images are memory-mapped when possible and labels are written straight to
+        a uint32 *_cp_masks.tif, so peak memory is bounded by the tile size. Returns
+        a list of (filename, error message) for images that failed.
+        """
+        errors = []
+
+        def eval_tile(tile):
+            tile_smoothed = transforms.smooth_sharpen_img(tile, smooth_radius=1, sharpen_radius=0)
+            masks, flows, styles, diams = self.model.eval(
+                tile_smoothed, diameter=diameter, channels=CHANNELS, flow_threshold=FLOW_THRESHOLD, cellprob_threshold=CELLPROB_THRESHOLD
+            )
+            return masks
 
         for idx, filename in enumerate(tqdm.tqdm(files)):
-            if stop_flag.stop:
+            if self.stop:
                 break
-            for chan in channels:
-                img = io.imread(filename)
-                img_smoothed = transforms.smooth_sharpen_img(img, smooth_radius=1, sharpen_radius=0)
-                masks, flows, styles, diams = self.model.eval(img_smoothed, diameter=diameter, channels=chan, flow_threshold=0.3, cellprob_threshold=0)
-                img_normalized = transforms.normalize99(img, lower=1, upper=99)
+            try:
+                with profiling.stage('segment_tiled', filename) as trace:
+                    image = tiling.open_image(filename)
+                    labels = tiling.create_label_output(mask_path_for(filename, tiled=True), image.shape[:2])
+                    _, n_labels = tiling.segment_tiled(image, eval_tile, tile_size=tile_size, overlap=overlap, out=labels)
+                    labels.flush()
+                    del labels
+                    trace['rois'] = n_labels
+                print(f"Segmented {filename} in tiles: {n_labels} labels")
+                if on_saved:
+                    on_saved(filename)
+            except Exception as e:
+                print(f"Error segmenting {filename}: {e}")
+                errors.append((filename, str(e)))
 
-                def save_masks_with_timeout(img, masks, flows, filename):
-                    stop_flag_local = StopFlag()
+            if progress_callback:
+                progress_callback(((idx + 1) / len(files)) * 100)
 
-                    def save_masks_thread(img):
-                        io.save_masks(img, masks, flows, filename, save_txt=False)
+        return errors
 
-                    t = threading.Timer(30.0, lambda: setattr(stop_flag_local, "stop", True))
-                    t.start()
-                    thread = threading.Thread(target=save_masks_thread, args=(img,))
-                    thread.start()
-                    thread.join(timeout=30.0)
-                    t.cancel()
+    def estimate_diameter(self, files, sample_size=CALIBRATION_SAMPLE_SIZE, tile_size=None):
+        """Estimate the cell diameter once for a set of images.
 
-                    if thread.is_alive():
-                        print("Saving masks taking too long, skipping...")
-                    else:
-                        pass
+        Runs Cellpose's size model on up to sample_size images spread evenly over
+        files (a centered tile_size crop of each in tiled mode) and returns the
+        median estimate, or None when no image could be measured. Segmenting with
+        this value avoids a size-model pass per image (diameter=0).
+        """
+        diameters = []
 
-                save_masks_with_timeout(img, masks, flows, filename)
+        for filename in calibration_sample(files, sample_size):
+            if self.stop:
+                break
+            try:
+                if tile_size:
+                    image = tiling.open_image(filename)
+                    y0, x0 = max(0, (image.shape[0] - tile_size) // 2), max(0, (image.shape[1] - tile_size) // 2)
+                    img = np.asarray(image[y0:y0 + tile_size, x0:x0 + tile_size])
+                    img_smoothed = transforms.smooth_sharpen_img(img, smooth_radius=1, sharpen_radius=0)
+                else:
+                    _, img_smoothed = read_image(filename)
+                with profiling.stage('calibrate', filename):
+                    diameter, _ = self.model.sz.eval(img_smoothed, channels=CHANNELS)
+                diameters.append(float(diameter))
+            except Exception as e:
+                print(f"Error estimating the diameter on {filename}: {e}")
 
-            if progress_callback:
-                progress = ((idx + 1) / total_files) * 100
-                progress_callback(progress)
+        if not diameters:
+            return None
+        estimate = float(np.median(diameters))
+        print(f"Estimated cell diameter {estimate:.1f} px (median of {len(diameters)} image(s), range {min(diameters):.1f}-{max(diameters):.1f})")
+        return estimate
 
-        if progress_callback:
-            progress_callback(100)  # Ensure progress is set to 100% after completion
+    def eval_batch(self, batch, diameter, chan, tile_batch_size=8):
+        """Run the model on a batch of same-shape images, returning (masks, flows) per image.
 
-        print(f"Segmentation completed in {time.time() - start_time:.2f} seconds")
+        The profiling trace gets one model_eval record per batch, naming every image in it.
+        """
+        imgs = [img_smoothed for _, _, img_smoothed in batch]
+        eval_kwargs = dict(batch_size=tile_batch_size, diameter=diameter, channels=chan, flow_threshold=FLOW_THRESHOLD, cellprob_threshold=CELLPROB_THRESHOLD)
+        model = self.model  # Load outside the timed stage
+
+        with profiling.stage('model_eval', ';'.join(filename for filename, _, _ in batch)) as trace:
+            if len(imgs) == 1:
+                masks, flows, styles, diams = model.eval(imgs[0], **eval_kwargs)
+                results = [(masks, flows)]
+            else:
+                masks, flows, styles, diams = model.eval(imgs, **eval_kwargs)
+                results = list(zip(masks, flows))
+            trace['rois'] = sum(int(np.max(masks)) if np.size(masks) else 0 for masks, _ in results)
+        return results
+
+
+def calibration_sample(files, sample_size=CALIBRATION_SAMPLE_SIZE):
+    """Up to sample_size files spread evenly over the sorted file list."""
+    files = sorted(files)
+    return files[::max(1, len(files) // max(1, sample_size))][:sample_size]
+
+
+def read_image(filename):
+    """Read an image and return it together with its smoothed copy for the model."""
+    with profiling.stage('imread', filename):
+        img = io.imread(filename)
+    with profiling.stage('smooth', filename):
+        img_smoothed = transforms.smooth_sharpen_img(img, smooth_radius=1, sharpen_radius=0)
+    return img, img_smoothed
+
+
+def prefetch_images(files, workers=2, prefetch=4):
+    """Yield (filename, img, img_smoothed, error) in order, reading ahead on a thread pool.
+
+    At most prefetch images are read or held ahead of the consumer. error is None
+    on success, otherwise the message of the exception raised while reading.
+    """
+    queue = deque()
+    files = iter(files)
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='image-reader')
+
+    def fill():
+        while len(queue) < max(1, prefetch):
+            filename = next(files, None)
+            if filename is None:
+                return
+            queue.append((filename, pool.submit(read_image, filename)))
+
+    try:
+        fill()
+        while queue:
+            filename, future = queue.popleft()
+            fill()
+            try:
+                img, img_smoothed = future.result()
+            except Exception as e:
+                yield filename, None, None, str(e)
+            else:
+                yield filename, img, img_smoothed, None
+    finally:
+        for _, future in queue:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+class MaskWriter:
+    """Save masks in the background on a bounded thread pool.
+
+    At most `workers` saves are in flight; submit waits for a free slot. A save
+    still running `timeout` seconds after it started is reported once but stays
+    pending and keeps its slot, so a stuck disk slows the run down instead of
+    piling up threads. on_saved(filename) is called, on the submitting thread,
+    for every successful save.
+    """
+
+    def __init__(self, workers=2, timeout=30.0, on_saved=None):
+        self.workers = max(1, workers)
+        self.on_saved = on_saved
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mask-writer')
+        self.pending = {}  # future -> [filename, deadline, reported as overdue]
+        self.errors = []
+
+    def submit(self, img, masks, flows, filename):
+        """Start saving masks for filename, waiting first if the writer is at capacity."""
+        self._collect(block=False)
+        while len(self.pending) >= self.workers:
+            self._collect(block=True)
+        # Every slot has a pool thread, so the save starts now and its deadline does too
+        future = self.pool.submit(self._save, img, masks, flows, filename)
+        self.pending[future] = [filename, time.time() + self.timeout, False]
+
+    def close(self):
+        """Wait for all outstanding saves, overdue ones included, and return the list of (filename, error message)."""
+        while self.pending:
+            self._collect(block=True)
+        self.pool.shutdown(wait=True)
+        return self.errors
+
+    @staticmethod
+    def _save(img, masks, flows, filename):
+        with profiling.stage('save_masks', filename):
+            io.save_masks(img, masks, flows, filename, save_txt=False)
+
+    def _collect(self, block):
+        """Record finished saves; with block, wait until one finishes or the next deadline passes."""
+        if block:
+            deadlines = [deadline for _, deadline, overdue in self.pending.values() if not overdue]
+            timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+            done, _ = wait(self.pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        else:
+            done = [future for future in self.pending if future.done()]
+
+        for future in done:
+            filename = self.pending.pop(future)[0]
+            error = future.exception()
+            if error is not None:
+                print(f"Error saving masks for {filename}: {error}")
+                self.errors.append((filename, str(error)))
+            elif self.on_saved:
+                self.on_saved(filename)
+
+        now = time.time()
+        for item in self.pending.values():
+            if not item[2] and now >= item[1]:
+                print(f"Saving masks for {item[0]} is taking longer than {self.timeout:g} seconds, still waiting...")
+                item[2] = True
@@ -0,0 +1,156 @@
+import sys
+import types
+
+import cv2
+import numpy as np
+import pytest
+
+import backend
+from backend import NUMPY_BACKEND, CupyBackend, get_backend, get_cupy
+from l2r import compute_roi_stats, render_overlays
+
+LABELS = np.array([
+    [0, 1, 1, 0, 0, 0],
+    [0, 1, 1, 0, 2, 0],
+    [0, 0, 0, 0, 2, 0],
+    [0, 0, 0, 0, 2, 2],
+], dtype=np.uint16)
+
+INTENSITY = np.array([
+    [9, 10, 20, 9, 9, 9],
+    [9, 30, 40, 9, 1, 9],
+    [9, 9, 9, 9, 2, 9],
+    [9, 9, 9, 9, 3, 6],
+], dtype=np.uint8)
+
+
+@pytest.fixture
+def no_cupy(monkeypatch):
+    """Make `import cupy` fail and forget any earlier check."""
+    monkeypatch.setattr(backend, '_cupy', False)
+    monkeypatch.setitem(sys.modules, 'cupy', None)
+
+
+def test_get_backend_falls_back_to_numpy_without_cupy(no_cupy):
+    assert get_cupy() is None
+    assert get_backend(use_gpu=True) is NUMPY_BACKEND
+    assert get_backend(use_gpu=False) is NUMPY_BACKEND
+
+
+def test_get_backend_falls_back_to_numpy_without_a_device(monkeypatch):
+    def no_device():
+        raise RuntimeError("no CUDA-capable device is detected")
+
+    cupy = types.ModuleType('cupy')
+    cupy.cuda = types.SimpleNamespace(runtime=types.SimpleNamespace(getDeviceCount=no_device))
+    monkeypatch.setattr(backend, '_cupy', False)
+    monkeypatch.setitem(sys.modules, 'cupy', cupy)
+    assert get_backend(use_gpu=True) is NUMPY_BACKEND
+
+
+def test_compute_roi_stats_known_values(no_cupy):
+    stats = compute_roi_stats(LABELS, INTENSITY, backend=get_backend(use_gpu=True))
+
+    assert all(isinstance(column, np.ndarray) for column in stats.values())
+    np.testing.assert_array_equal(stats['Label'], [1, 2])
+    np.testing.assert_array_equal(stats['Area'], [4, 4])
+    np.testing.assert_array_equal(stats['Integrated Density'], [100, 12])
+    np.testing.assert_array_equal(stats['Mean Gray Value'], [25.0, 3.0])
+    np.testing.assert_allclose(stats['Standard Deviation'], [np.sqrt(125.0), np.sqrt(3.5)])
+    np.testing.assert_array_equal(stats['Centroid X'], [1.5, 4.25])
+    np.testing.assert_array_equal(stats['Centroid Y'], [0.5, 2.25])
+    np.testing.assert_array_equal(stats['BBox X'], [1, 4])
+    np.testing.assert_array_equal(stats['BBox Y'], [0, 1])
+    np.testing.assert_array_equal(stats['BBox Width'], [2, 2])
+    np.testing.assert_array_equal(stats['BBox Height'], [2, 3])
+
+
+def test_render_overlays_known_values(no_cupy):
+    original = cv2.cvtColor(INTENSITY, cv2.COLOR_GRAY2BGR)
+    overlay, blended, labels, centroids = render_overlays(LABELS, original, backend=get_backend(use_gpu=True), alpha=0.2)
+
+    np.testing.assert_array_equal(labels, [1, 2])
+    np.testing.assert_array_equal(centroids, [[1, 0], [4, 2]])  # Truncated (x, y) means
+
+    assert overlay.shape == original.shape and overlay.dtype == np.uint8
+    assert not overlay[LABELS == 0].any()
+    for label in (1, 2):
+        colors = overlay[LABELS == label]
+        assert (colors == colors[0]).all()  # One color per label
+
+    np.testing.assert_array_equal(blended, cv2.addWeighted(original, 0.2, overlay, 0.8, 0))
+
+
+def numpy_shim():
+    """A module that behaves like numpy but is not numpy, standing in for cupy on the device code paths."""
+    shim = types.ModuleType('numpy_shim')
+    shim.__dict__.update((name, getattr(np, name)) for name in dir(np) if not name.startswith('__'))
+    shim.asnumpy = np.asarray
+    return shim
+
+
+@pytest.fixture
+def shim_backend(monkeypatch):
+    """CupyBackend running on numpy_shim, with cupyx's scatter functions done by NumPy."""
+    cupyx = types.ModuleType('cupyx')
+    cupyx.scatter_min = np.minimum.at
+    cupyx.scatter_max = np.maximum.at
+    monkeypatch.setitem(sys.modules, 'cupyx', cupyx)
+    shim_backend = CupyBackend(numpy_shim())
+    assert shim_backend.xp is not np
+    return shim_backend
+
+
+def random_label_image(shape=(60, 80), n_labels=30, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, n_labels + 1, size=shape).astype(np.uint16)
+    labels[labels == 7] = 0  # Missing label number
+    return labels, rng.integers(0, 256, size=shape, dtype=np.uint8)
+
+
+def test_compute_roi_stats_device_path_matches_numpy(shim_backend):
+    label_image, intensity = random_label_image()
+    expected = compute_roi_stats(label_image, intensity, backend=NUMPY_BACKEND)
+    stats = compute_roi_stats(label_image, intensity, backend=shim_backend)
+
+    assert list(stats) == list(expected)
+    for header, column in expected.items():
+        assert isinstance(stats[header], np.ndarray) and stats[header].dtype == column.dtype, header
+        if header == 'Standard Deviation':
+            np.testing.assert_allclose(stats[header], column, rtol=1e-12)  # Summed in a different order
+        else:
+            np.testing.assert_array_equal(stats[header], column, err_msg=header)
+
+
+def test_render_overlays_device_path_matches_numpy(shim_backend):
+    label_image, intensity = random_label_image()
+    original = cv2.cvtColor(intensity, cv2.COLOR_GRAY2BGR)
+
+    np.random.seed(0)  # Same label colors on both backends
+    expected = render_overlays(label_image, original, backend=NUMPY_BACKEND)
+    np.random.seed(0)
+    results = render_overlays(label_image, original, backend=shim_backend)
+
+    for name, result, array in zip(('overlay', 'blended', 'labels', 'centroids'), results, expected):
+        assert isinstance(result, np.ndarray) and result.dtype == array.dtype, name
+        np.testing.assert_array_equal(result, array, err_msg=name)
+
+
+def test_cupy_to_host_packs_by_dtype(shim_backend):
+    arrays = (
+        np.arange(5, dtype=np.int64),
+        np.linspace(0, 1, 6, dtype=np.float64).reshape(2, 3),
+        np.array([7, 8], dtype=np.int64),
+        np.arange(12, dtype=np.uint8).reshape(3, 2, 2),
+        np.array([], dtype=np.float64),
+    )
+    results = shim_backend.to_host(*arrays)
+
+    assert isinstance(results, tuple) and len(results) == len(arrays)
+    for result, array in zip(results, arrays):
+        assert result.dtype == array.dtype and result.shape == array.shape
+        np.testing.assert_array_equal(result, array)
+
+    single = shim_backend.to_host(arrays[1])
+    assert isinstance(single, np.ndarray)
+    np.testing.assert_array_equal(single, arrays[1])
@@ -0,0 +1,40 @@
+import numpy as np
+
+from l2r import compute_roi_stats
+
+
+def synthetic_label_image(shape=(120, 160), n_labels=40, seed=0):
+    """Label image with irregular, touching and split labels, a gap in the label numbers and background."""
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, n_labels + 1, size=(shape[0] // 4, shape[1] // 4))
+    labels = np.kron(labels, np.ones((4, 4), dtype=labels.dtype))  # 4x4 blocks, so labels have several pixels
+    labels[rng.random(shape) < 0.1] = n_labels + 5  # Scattered pixels of one label far from the others
+    labels[labels == 3] = 0  # Missing label number
+    intensity = rng.integers(0, 256, size=shape, dtype=np.uint8)
+    return labels.astype(np.uint16), intensity
+
+
+def test_compute_roi_stats_matches_per_label_loop():
+    label_image, intensity = synthetic_label_image()
+    stats = compute_roi_stats(label_image, intensity)
+
+    expected_labels = np.unique(label_image)
+    expected_labels = expected_labels[expected_labels > 0]
+    np.testing.assert_array_equal(stats['Label'], expected_labels)
+
+    for i, label in enumerate(expected_labels):
+        mask = label_image == label
+        rows, cols = np.nonzero(mask)
+        assert stats['Area'][i] == np.sum(mask)
+        assert stats['Integrated Density'][i] == np.sum(intensity[mask])
+        assert stats['Mean Gray Value'][i] == np.mean(intensity[mask])
+        assert stats['Standard Deviation'][i] == np.std(intensity[mask])
+        assert stats['Centroid X'][i] == np.mean(cols)
+        assert stats['Centroid Y'][i] == np.mean(rows)
+        assert (stats['BBox X'][i], stats['BBox Y'][i]) == (cols.min(), rows.min())
+        assert (stats['BBox Width'][i], stats['BBox Height'][i]) == (np.ptp(cols) + 1, np.ptp(rows) + 1)
+
+
+def test_compute_roi_stats_without_labels():
+    stats = compute_roi_stats(np.zeros((8, 8), dtype=np.uint16), np.ones((8, 8), dtype=np.uint8))
+    assert all(len(column) == 0 for column in stats.values())
@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+from imagecache import TIFFFILE_AVAILABLE, memmap_tiff
+
+# Tiled mode processes images in square tiles, so peak memory depends on the tile
+# size rather than the image size. Whole images are only loaded when a file cannot
+# be memory-mapped (compressed or non-TIFF files).
+
+
+def tile_origins(height, width, tile_size):
+    """Yield the (y, x) origin of every tile covering a height x width image."""
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            yield y0, x0
+
+
+def open_labels(path):
+    """Open a label image for tiled reading, memory-mapped when possible."""
+    label_image = memmap_tiff(path)
+    if label_image is None or label_image.ndim != 2:
+        label_image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    return label_image
+
+
+def open_gray(path):
+    """Open an image for tiled reading as (array, to_gray).
+
+    to_gray(tile) converts a tile of array to the 8-bit grayscale values
+    cv2.IMREAD_GRAYSCALE would produce. 8- and 16-bit single-channel TIFFs are
+    memory-mapped; anything else is decoded whole with OpenCV.
+    """
+    mapped = memmap_tiff(path)
+    if mapped is not None and mapped.ndim == 2 and mapped.dtype == np.uint8:
+        return mapped, np.asarray
+    if mapped is not None and mapped.ndim == 2 and mapped.dtype == np.uint16:
+        return mapped, lambda tile: (np.asarray(tile) >> 8).astype(np.uint8)
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE), np.asarray
+
+
+def open_image(path):
+    """Open an image for tiled segmentation, memory-mapped when possible."""
+    mapped = memmap_tiff(path)
+    if mapped is not None and (mapped.ndim == 2 or (mapped.ndim == 3 and mapped.shape[-1] <= 4)):
+        return mapped
+    from cellpose import io
+    return io.imread(path)
+
+
+def create_label_output(path, shape):
+    """Create a uint32 label TIFF at path and return it memory-mapped for writing.
+
+    Labels go straight to disk, so the full label image never has to fit in memory.
+    """
+    if not TIFFFILE_AVAILABLE:
+        raise RuntimeError("Tiled segmentation needs the tifffile package.")
+    import tifffile
+    return tifffile.memmap(path, shape=shape, dtype=np.uint32)
+
+
+def segment_tiled(image, eval_tile, tile_size=2048, overlap=128, out=None):
+    """Segment a large image tile by tile and stitch the labels across tile borders.
+
+    Every tile is segmented together with `overlap` extra pixels on each side.
+    A cell is kept only by the tile whose core (the tile without the margin)
+    contains its centroid, so a cell crossing a border is taken whole from one
+    tile and never appears twice. overlap should be at least the largest cell
+    diameter. eval_tile(tile) returns the label image of one tile.
+
+    Labels are written into out (created as a uint32 array when not given).
+    Returns (out, number of labels).
+    """
+    height, width = image.shape[:2]
+    if out is None:
+        out = np.zeros((height, width), dtype=np.uint32)
+    next_label = 1
+
+    for y0, x0 in tile_origins(height, width, tile_size):
+        y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+        py0, px0 = max(0, y0 - overlap), max(0, x0 - overlap)
+        py1, px1 = min(height, y1 + overlap), min(width, x1 + overlap)
+
+        masks = np.asarray(eval_tile(np.asarray(image[py0:py1, px0:px1])))
+        labels_flat = masks.reshape(-1).astype(np.intp)
+        n_bins = int(labels_flat.max()) + 1 if labels_flat.size else 1
+        if n_bins <= 1:
+            continue
+
+        # Centroid of every label in image coordinates
+        tile_width = px1 - px0
+        pixel_index = np.arange(labels_flat.size)
+        counts = np.bincount(labels_flat, minlength=n_bins)
+        area = np.maximum(counts, 1)
+        center_y = np.bincount(labels_flat, weights=pixel_index // tile_width, minlength=n_bins) / area + py0
+        center_x = np.bincount(labels_flat, weights=pixel_index % tile_width, minlength=n_bins) / area + px0
+
+        keep = (counts > 0) & (center_y >= y0) & (center_y < y1) & (center_x >= x0) & (center_x < x1)
+        keep[0] = False
+        new_labels = np.zeros(n_bins, dtype=np.uint32)
+        new_labels[keep] = np.arange(next_label, next_label + keep.sum(), dtype=np.uint32)
+        next_label += int(keep.sum())
+
+        relabeled = new_labels[masks]
+        region = out[py0:py1, px0:px1]
+        write = (relabeled > 0) & (region == 0)  # Never overwrite a cell kept by an earlier tile
+        region[write] = relabeled[write]
+
+    return out, next_label - 1